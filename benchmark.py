@@ -0,0 +1,311 @@
+import os, sys
+import argparse, json, math, platform, random, time
+
+#no window needed for any of this
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import numpy as np
+import pygame
+from shapely.geometry import Polygon
+from game import (SCREEN_WIDTH, SCREEN_HEIGHT, TICK_RATE, RELOAD_TICKS, init_display, new_game, boat_art,
+                  get_list_from_polygon, rotate_polygon, move_polygon, get_polygon_center, normalize_vector,
+                  Game, Dashboard, Scheduler, EntityRegistry, Projectiles, Island, User, Enemy)
+
+init_display(headless=True)
+
+####################################################################
+    #HELPERS
+####################################################################
+
+def time_it(func, repeat=20, setup=None):
+    #best of a few runs so noise from the rest of the machine doesn't show up as much
+    best = None
+    for i in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        func(*args)
+        took = time.perf_counter() - start
+        best = took if best is None or took < best else best
+    return best
+
+def build_battle(n_entities, seed=1):
+    #half enemies spread over the map, half shells flying around between them
+    random.seed(seed)
+    G1 = Game({ "s_h": SCREEN_HEIGHT *  7 / 8, "s_w": SCREEN_WIDTH })
+    all_sprites = EntityRegistry()
+    user = User({ "pos": (SCREEN_WIDTH /2,  SCREEN_HEIGHT * 7/8 - 30), "fwards_or_bwards": 1})
+    all_sprites.add(user)
+    for i in range(n_entities // 2):
+        all_sprites.add(Enemy({ "pos": (random.uniform(20, SCREEN_WIDTH - 20), random.uniform(20, SCREEN_HEIGHT * 7/8 - 20)),
+                                "fwards_or_bwards": -1, "id": i }))
+    for i in range(n_entities - n_entities // 2):
+        start = (random.uniform(0, SCREEN_WIDTH), random.uniform(0, SCREEN_HEIGHT * 7/8))
+        G1.projectiles.spawn_shell(start, (random.uniform(0, SCREEN_WIDTH), random.uniform(0, SCREEN_HEIGHT * 7/8)), random.random() < 0.5)
+    return G1, all_sprites, user
+
+def build_particles(n_particles, seed=1):
+    #half shells half shrapnel, all alive
+    random.seed(seed)
+    projectiles = Projectiles()
+    for i in range(n_particles // 2):
+        projectiles.spawn_shell((random.uniform(1, SCREEN_WIDTH - 1), random.uniform(1, SCREEN_HEIGHT - 1)), (0, 0), random.random() < 0.5)
+    while len(np.flatnonzero(projectiles.alive)) < n_particles:
+        projectiles.spawn_shrapnel((random.uniform(0, SCREEN_WIDTH), random.uniform(0, SCREEN_HEIGHT)), (1, 1), True)
+    return projectiles,
+
+def build_scenario(n_enemies, n_shells, seed=1):
+    #a match like new_game makes, with n_enemies spread out above the user and n_shells in the air
+    random.seed(seed)
+    G1, dashboard, all_sprites, user = new_game(seed=seed)
+    for i in range(n_enemies):
+        all_sprites.add(Enemy({ "pos": (random.uniform(20, SCREEN_WIDTH - 20), random.uniform(20, SCREEN_HEIGHT * 7/8 - 120)),
+                                "fwards_or_bwards": -1, "id": G1.next_enemy_id }))
+        G1.next_enemy_id += 1
+    for i in range(n_shells):
+        start = (random.uniform(0, SCREEN_WIDTH), random.uniform(0, SCREEN_HEIGHT * 7/8))
+        G1.projectiles.spawn_shell(start, (random.uniform(0, SCREEN_WIDTH), random.uniform(0, SCREEN_HEIGHT * 7/8)), random.random() < 0.5)
+    return G1, all_sprites, user, dashboard
+
+def build_warm_scenario(n_enemies, n_shells, seed=1):
+    #the same after one tick. the first tick of a match streams in the first chunk of islands and
+    #builds the flow field from nothing, which is several times a normal tick and only happens once
+    G1, all_sprites, user, dashboard = build_scenario(n_enemies, n_shells, seed)
+    G1.update(all_sprites, user, dashboard)
+    return G1, all_sprites, user, dashboard
+
+####################################################################
+    #BENCHMARKS
+####################################################################
+
+def bench_geometry(n_calls=1000):
+    #the little helpers the boats are built from, each one called on a hull
+    print("geometry helpers")
+    print("%24s %12s" % ("helper", "us/call"))
+    points = list(User({ "pos": (400, 400), "fwards_or_bwards": 1 }).get_hull_coords())
+    polygon = Polygon(points)
+    helpers = {
+        "get_list_from_polygon": lambda: get_list_from_polygon(polygon),
+        "rotate_polygon": lambda: rotate_polygon(polygon, 30),
+        "move_polygon": lambda: move_polygon(points, (3, -2)),
+        "get_polygon_center": lambda: get_polygon_center(points),
+        "normalize_vector": lambda: normalize_vector(3.5, -2.25),
+    }
+    results = {}
+    for name, func in helpers.items():
+        def run():
+            for i in range(n_calls):
+                func()
+        took = time_it(run, repeat=10) / n_calls
+        results["geometry." + name] = took
+        print("%24s %12.3f" % (name, took * 1000000))
+    return results
+
+def bench_scenarios(sizes=((10, 50), (50, 250), (100, 1000), (250, 2000))):
+    #whole ticks and whole frames of a match, what a player actually waits on
+    print("Game.update and Game.draw, one tick / one frame")
+    print("%10s %10s %12s %12s" % ("enemies", "shells", "update ms", "draw ms"))
+    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    results = {}
+    for n_enemies, n_shells in sizes:
+        #a tick moves everything on, so every run gets a fresh match that is already past its first tick
+        update = time_it(lambda G1, all_sprites, user, dashboard: G1.update(all_sprites, user, dashboard),
+                         repeat=20, setup=lambda: build_warm_scenario(n_enemies, n_shells))
+        #drawing doesn't change anything, but the first frame draws every boat into boat_art so leave that out
+        G1, all_sprites, user, dashboard = build_warm_scenario(n_enemies, n_shells)
+        G1.draw(screen, all_sprites, dashboard)
+        draw = time_it(lambda: G1.draw(screen, all_sprites, dashboard), repeat=20)
+        results["update.%dx%d" % (n_enemies, n_shells)] = update
+        results["draw.%dx%d" % (n_enemies, n_shells)] = draw
+        print("%10d %10d %12.3f %12.3f" % (n_enemies, n_shells, update * 1000, draw * 1000))
+    return results
+
+
+def bench_handle_shells(sizes=(10, 50, 100, 250, 500, 1000, 2000)):
+    print("handle_shells, one frame")
+    print("%10s %12s" % ("entities", "ms/frame"))
+    for n in sizes:
+        #hits remove shells and hurt boats, so every run starts from a fresh battle
+        took = time_it(lambda G1, all_sprites, user: G1.handle_shells(all_sprites, user),
+                       repeat=10, setup=lambda: build_battle(n))
+        print("%10d %12.3f" % (n, took * 1000))
+
+def bench_projectiles(sizes=(100, 1000, 10000, 50000)):
+    print("Projectiles.step, one tick")
+    print("%10s %12s" % ("particles", "ms/tick"))
+    for n in sizes:
+        took = time_it(lambda projectiles: projectiles.step(), repeat=10, setup=lambda: build_particles(n))
+        print("%10d %12.3f" % (n, took * 1000))
+
+def bench_enemy_ai(sizes=(10, 100, 200, 1000)):
+    print("Game.aim_enemies, one tick")
+    print("%10s %12s" % ("enemies", "ms/tick"))
+    for n in sizes:
+        took = time_it(lambda G1, all_sprites, user: G1.aim_enemies(all_sprites),
+                       repeat=10, setup=lambda: build_battle(n * 2))
+        print("%10d %12.3f" % (n, took * 1000))
+
+def bench_timers(sizes=(1, 100, 10000)):
+    print("Scheduler, one reload per enemy fired")
+    print("%10s %12s" % ("enemies", "us/timer"))
+    for n in sizes:
+        def run():
+            #everyone fires on different ticks, then the whole reload runs out
+            timers = Scheduler()
+            for i in range(n):
+                timers.schedule(RELOAD_TICKS + i % TICK_RATE, i)
+            for tick in range(RELOAD_TICKS + TICK_RATE):
+                timers.pop_due()
+                timers.advance()
+        took = time_it(run, repeat=10)
+        print("%10d %12.3f" % (n, took / n * 1000000))
+
+def build_boats(n_boats, seed=1):
+    #boats at every sort of heading with their turrets pointing all over
+    random.seed(seed)
+    boats = []
+    for i in range(n_boats):
+        boat = User({ "pos": (random.uniform(30, SCREEN_WIDTH - 30), random.uniform(30, SCREEN_HEIGHT * 7/8 - 30)),
+                       "fwards_or_bwards": random.choice((1, -1)) })
+        boat.cur_turn = random.uniform(0, 360)
+        boat.set_tur_end_pos(boat.get_center(), (random.uniform(0, SCREEN_WIDTH), random.uniform(0, SCREEN_HEIGHT)))
+        boats.append(boat)
+    return boats
+
+def bench_boat_draw(sizes=(200, 1000)):
+    print("drawing a boat, hull and turret")
+    print("%10s %20s %12s" % ("boats", "path", "us/boat"))
+    #the pictures are converted to the screen format when there is a screen, so give them one
+    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    map_surface = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT * 7/8)).convert()
+    for n_boats in sizes:
+        boats = build_boats(n_boats)
+        def polygons():
+            for boat in boats:
+                boat.draw_hull(map_surface)
+                boat.draw_turret(map_surface, boat.get_center())
+        def cached():
+            for boat in boats:
+                boat.draw(map_surface)
+        for name, func, antialias in (("polygons", polygons, False), ("cached", cached, False), ("cached antialiased", cached, True)):
+            boat_art.antialias = antialias
+            #warm the cache first, a boat turning to a new heading only pays for the picture once
+            func()
+            took = time_it(func, repeat=10)
+            print("%10d %20s %12.2f" % (n_boats, name, took / n_boats * 1000000))
+    boat_art.antialias = False
+
+def bench_tunnelling(speeds=(5, 10, 20, 40, 80), n_shells=200):
+    #shells fired straight at a boat from all round it, every one of them should hit.
+    #"point" only checks where each shell ends up every tick, like handle_shells used to.
+    #gives back the speeds where the swept test let any through
+    print("shells that hit a boat they were fired straight at")
+    print("%10s %12s %12s" % ("px/tick", "point", "swept"))
+    missed = []
+    for speed in speeds:
+        hits = []
+        for swept in (False, True):
+            random.seed(speed)
+            G1, all_sprites, user = build_battle(0)
+            enemy = Enemy({ "pos": (SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2 - 30), "fwards_or_bwards": -1, "id": 1 })
+            enemy.health = 10 * n_shells
+            all_sprites.add(enemy)
+            center = enemy.get_center()
+            for i in range(n_shells):
+                angle, distance = random.uniform(0, 2 * math.pi), random.uniform(100, 200)
+                start = (center[0] + distance * math.cos(angle), center[1] + distance * math.sin(angle))
+                G1.projectiles.spawn_shell(start, center, True, firing_speed=speed)
+            while len(G1.projectiles.live_shells()):
+                if not swept:
+                    G1.projectiles.prev_x[:], G1.projectiles.prev_y[:] = G1.projectiles.x, G1.projectiles.y
+                G1.handle_shells(all_sprites, user)
+                G1.projectiles.step()
+            hits.append((10 * n_shells - enemy.health) // 10)
+        print("%10d %11.0f%% %11.0f%%%s" % (speed, hits[0] * 100 / n_shells, hits[1] * 100 / n_shells, "" if hits[1] == n_shells else "  MISSED"))
+        if hits[1] != n_shells:
+            missed.append(speed)
+    return missed
+
+def build_fleet(n_enemies, seed=1):
+    #a battle with a row of islands between the fleet and the user, and the flow field already worked out
+    G1, all_sprites, user = build_battle(n_enemies * 2, seed)
+    for x in range(150, 650, 50):
+        all_sprites.add(Island({ "pos": (x, 280) }))
+    G1.steer_enemies(all_sprites)
+    return G1, all_sprites, user, Dashboard()
+
+def bench_navigation(sizes=(10, 100, 1000)):
+    print("enemies steering round islands, one tick")
+    print("%10s %12s %12s" % ("enemies", "steer ms", "update ms"))
+    for n in sizes:
+        steer = time_it(lambda G1, all_sprites, user, dashboard: G1.steer_enemies(all_sprites),
+                        repeat=10, setup=lambda: build_fleet(n))
+        update = time_it(lambda G1, all_sprites, user, dashboard: G1.update(all_sprites, user, dashboard),
+                         repeat=10, setup=lambda: build_fleet(n))
+        print("%10d %12.3f %12.3f" % (n, steer * 1000, update * 1000))
+    #and what it costs when the user moves into a new cell
+    G1, all_sprites, user, dashboard = build_fleet(10)
+    def rebuild():
+        G1.flow.key = None
+        G1.steer_enemies(all_sprites)
+    print("flow field rebuild %.3f ms" % (time_it(rebuild) * 1000))
+
+####################################################################
+    #BASELINES
+####################################################################
+
+def save_baseline(path, results):
+    with open(path, "w") as f:
+        json.dump({ "python": platform.python_version(), "machine": platform.machine(),
+                    "results": results }, f, indent=2)
+
+def check_baseline(path, results, threshold):
+    #only the scenarios can fail, the helpers are a few microseconds and far too noisy on their own.
+    #gives back the names of whatever got more than threshold percent slower
+    with open(path) as f:
+        baseline = json.load(f)["results"]
+    print("against %s, fails over +%.0f%%" % (path, threshold))
+    print("%30s %12s %12s %8s" % ("benchmark", "baseline ms", "now ms", "change"))
+    slower = []
+    for name, took in results.items():
+        if name not in baseline:
+            continue
+        change = (took / baseline[name] - 1) * 100
+        failed = change > threshold and not name.startswith("geometry.")
+        print("%30s %12.4f %12.4f %+7.0f%%%s" % (name, baseline[name] * 1000, took * 1000, change, "  SLOWER" if failed else ""))
+        if failed:
+            slower.append(name)
+    return slower
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    #baselines only cover the helpers and the scenarios, the rest is for reading
+    parser.add_argument("--save", metavar="PATH", help="write the helper and scenario timings to a .json baseline")
+    parser.add_argument("--check", metavar="PATH", help="compare against a baseline, exit 1 if a scenario got slower or a shell tunnelled")
+    parser.add_argument("--threshold", type=float, default=25, help="percent slower a scenario can get before --check fails")
+    args = parser.parse_args()
+
+    results = bench_geometry()
+    results.update(bench_scenarios())
+    if args.save:
+        save_baseline(args.save, results)
+    if args.check:
+        slower = check_baseline(args.check, results, args.threshold)
+        missed = bench_tunnelling()
+        if slower:
+            print("slower than the baseline: " + ", ".join(slower))
+        if missed:
+            print("swept shells missed at px/tick: " + ", ".join(str(speed) for speed in missed))
+        sys.exit(1 if slower or missed else 0)
+    if args.save:
+        sys.exit(0)
+
+    bench_handle_shells()
+    bench_projectiles()
+    bench_enemy_ai()
+    bench_timers()
+    missed = bench_tunnelling()
+    bench_navigation()
+    bench_boat_draw()
+    if missed:
+        print("swept shells missed at px/tick: " + ", ".join(str(speed) for speed in missed))
+        sys.exit(1)
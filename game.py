@@ -1,23 +1,164 @@
-import pygame, sys
+import os, sys, time
+#for timing how long it takes to get the menu up
+STARTED_AT = time.perf_counter()
+import argparse, bisect, contextlib, csv, itertools, json, queue, struct, threading
 import math, random
+from collections import OrderedDict, deque
+import numpy as np
 from shapely import affinity
-from shapely.geometry import Point, Polygon
+import pygame
 
 ####################################################################
 
-pygame.init()
+#nothing here touches SDL when the module is imported, the display and fonts get
+#started the first time something needs them
 SCREEN_WIDTH, SCREEN_HEIGHT = 800, 600
-font = pygame.font.SysFont("Verdana", 60)
-font_med = pygame.font.SysFont("Verdana", 30)
-font_small = pygame.font.SysFont("Verdana", 20)
-
-def disp_icon():
-    logo = pygame.image.load("logo.png")
-    pygame.display.set_icon(logo)
+#the simulation always runs at this many ticks a second whatever the frame rate is
+TICK_RATE = 60
+FONT_NAME = "Verdana"
+#SysFont scans every font on the system to find one, so where it found it last time is kept here
+FONT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "frigate2", "fonts.json")
+#F5 saves the match here and F9 loads it back
+SAVE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "frigate2", "quicksave.frs")
+#every finished game's score, see HighScores
+SCORES_PATH = os.path.join(os.path.expanduser("~"), ".cache", "frigate2", "scores.log")
+fonts = {}
+
+def init_display(headless=False):
+    #headless runs never open a window, so SDL gets the dummy video driver before it starts
+    if headless:
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    if not pygame.display.get_init():
+        pygame.display.init()
+
+def find_font_path(name):
+    try:
+        with open(FONT_CACHE_PATH) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    path = cache.get(name, "")
+    #None means the scan already came up empty last time, so go straight to pygame's own font
+    if path is None or (path and os.path.exists(path)):
+        return path
+    path = pygame.font.match_font(name)
+    cache[name] = path
+    try:
+        os.makedirs(os.path.dirname(FONT_CACHE_PATH), exist_ok=True)
+        with open(FONT_CACHE_PATH, "w") as f:
+            json.dump(cache, f)
+    except OSError:
+        pass
+    return path
+
+def get_font(size):
+    if size not in fonts:
+        if not pygame.font.get_init():
+            pygame.font.init()
+        if "path" not in fonts:
+            fonts["path"] = find_font_path(FONT_NAME)
+        fonts[size] = pygame.font.Font(fonts["path"], size)
+    return fonts[size]
+
+class IconLoader():
+    #loads the window icon on a background thread so the menu doesn't have to wait for it,
+    #the main loop calls apply() every frame and it gets set as soon as it is there
+    def __init__(self, path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "logo.png")):
+        self.image = None
+        self.applied = False
+        self.thread = threading.Thread(target=self.load, args=(path,), daemon=True)
+        self.thread.start()
+
+    def load(self, path):
+        try:
+            self.image = pygame.image.load(path)
+        except (pygame.error, OSError):
+            self.applied = True
+
+    def apply(self):
+        if not self.applied and self.image is not None:
+            pygame.display.set_icon(self.image)
+            self.applied = True
 
 ####################################################################
 
 
+class HighScores():
+    #every finished game goes on the end of an append only log as a fixed size record (score, unix time).
+    #only the best `size` are kept in memory and that is all the high score screen ever reads. one
+    #background thread loads the log when the game starts and then does all the writing, so neither
+    #startup nor the game loop ever waits on the disk. a torn last record from a crash gets cut off
+    RECORD = np.dtype([("score", "<i4"), ("time", "<u4")])
+
+    def __init__(self, path=SCORES_PATH, size=10):
+        self.path = path
+        self.size = size
+        self.top = []
+        self.loaded = False
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, score, when=None):
+        record = (int(score), int(time.time()) if when is None else when)
+        with self.lock:
+            self.top = self.best(self.top + [record])
+        self.queue.put(record)
+
+    def get_top(self):
+        with self.lock:
+            return list(self.top)
+
+    def best(self, records):
+        #highest first, and the older score wins a tie
+        return sorted(records, key=lambda record: -record[0])[:self.size]
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except OSError:
+            data = b""
+        whole = len(data) // self.RECORD.itemsize * self.RECORD.itemsize
+        if whole != len(data):
+            #cut the torn record off, otherwise everything appended after it would be out of line
+            with open(self.path, "r+b") as f:
+                f.truncate(whole)
+        records = np.frombuffer(data, self.RECORD, len(data) // self.RECORD.itemsize)
+        best = records[np.argsort(-records["score"], kind="stable")[:self.size]]
+        with self.lock:
+            #anything added while this was loading isn't in the file yet, so it goes after
+            self.top = self.best([(int(score), int(when)) for score, when in best.tolist()] + self.top)
+            self.loaded = True
+
+    def run(self):
+        self.load()
+        f = None
+        while True:
+            records = [self.queue.get()]
+            #whatever else piled up goes out with the same fsync
+            while not self.queue.empty():
+                records.append(self.queue.get())
+            done = None in records
+            records = [record for record in records if record is not None]
+            if records:
+                if f is None:
+                    os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                    f = open(self.path, "ab")
+                f.write(np.array(records, self.RECORD).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            if done:
+                if f:
+                    f.close()
+                return
+
+    def close(self, timeout=2):
+        #waits for whatever is queued to be on disk
+        self.queue.put(None)
+        self.thread.join(timeout)
+
 ####################################################################
     #HELPER FUNCTIONS
 ####################################################################
@@ -57,6 +198,70 @@ def move_polygon(poly, movement_tuple):
         new_poly.append((coord[0] + movement_tuple[0], coord[1] + movement_tuple[1]))
     return new_poly
 
+def rotate_points(points, rotation, origin):
+    #same maths as affinity.rotate but on plain tuples, rotation in degrees
+    angle = math.radians(rotation)
+    cos_a, sin_a = math.cos(angle), math.sin(angle)
+    ox, oy = origin
+    return [(ox + (x - ox) * cos_a - (y - oy) * sin_a, oy + (x - ox) * sin_a + (y - oy) * cos_a) for x, y in points]
+
+def point_in_polygon(x, y, points):
+    #ray casting, points is a closed ring like the ones get_list_from_polygon gives back
+    inside = False
+    x1, y1 = points[-1]
+    for x2, y2 in points:
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+        x1, y1 = x2, y2
+    return inside
+
+def points_in_polygon(xs, ys, points):
+    #point_in_polygon for a whole array of points at once
+    inside = np.zeros(len(xs), np.bool_)
+    x1, y1 = points[-1]
+    for x2, y2 in points:
+        if y1 != y2:
+            crosses = ((y1 > ys) != (y2 > ys)) & (xs < x1 + (ys - y1) * (x2 - x1) / (y2 - y1))
+            inside ^= crosses
+        x1, y1 = x2, y2
+    return inside
+
+def segment_hits_polygon(x1, y1, x2, y2, points):
+    #how far along the segment from (x1, y1) to (x2, y2) it first touches the polygon, 0 to 1, or None if it never does
+    if point_in_polygon(x1, y1, points):
+        return 0.0
+    dx, dy = x2 - x1, y2 - y1
+    first = None
+    ax, ay = points[-1]
+    for bx, by in points:
+        ex, ey = bx - ax, by - ay
+        denom = dx * ey - dy * ex
+        #parallel edges (and the repeated point closing the ring) can't be crossed
+        if denom != 0:
+            wx, wy = ax - x1, ay - y1
+            t, u = (wx * ey - wy * ex) / denom, (wx * dy - wy * dx) / denom
+            if 0 <= t <= 1 and 0 <= u <= 1 and (first is None or t < first):
+                first = t
+        ax, ay = bx, by
+    return first
+
+def segments_hit_polygon(x1s, y1s, x2s, y2s, points):
+    #segment_hits_polygon for a whole array of segments at once, misses come back as inf
+    first = np.full(len(x1s), np.inf)
+    first[points_in_polygon(x1s, y1s, points)] = 0
+    dx, dy = x2s - x1s, y2s - y1s
+    ax, ay = points[-1]
+    for bx, by in points:
+        ex, ey = bx - ax, by - ay
+        denom = dx * ey - dy * ex
+        wx, wy = ax - x1s, ay - y1s
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t, u = (wx * ey - wy * ex) / denom, (wx * dy - wy * dx) / denom
+        crosses = (denom != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+        first = np.where(crosses & (t < first), t, first)
+        ax, ay = bx, by
+    return first
+
 def get_vector_length(x, y):
     return math.sqrt(x*x + y*y)
 
@@ -67,51 +272,375 @@ def normalize_vector(x, y):
     else:
         return x, y
 
+class SpatialHash():
+    #uniform grid used as a broad phase, things are bucketed by their bounding box
+    #so a shell only has to be checked against whatever shares its cells
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def clear(self):
+        self.cells.clear()
+
+    def insert(self, item, bounds):
+        minx, miny, maxx, maxy = bounds
+        for cx in range(int(minx // self.cell_size), int(maxx // self.cell_size) + 1):
+            for cy in range(int(miny // self.cell_size), int(maxy // self.cell_size) + 1):
+                self.cells.setdefault((cx, cy), []).append(item)
+
+class FlowField():
+    #one breadth first search out from the goals over a grid of the map, then every cell points at
+    #whichever neighbour is a step closer to the nearest of them. anything anywhere on the grid finds
+    #its way with one lookup. it is only worked out again when a goal changes cell or the obstacles change
+    NEIGHBOURS = ((-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1))
+
+    def __init__(self, cell_size=25, margin=10):
+        self.cell_size = cell_size
+        #how far to keep from obstacles, about half a boat's width
+        self.margin = margin
+        self.key = None
+        self.rebuilds = 0
+
+    def update(self, goals, obstacles, bounds):
+        #goals are points, obstacles are rects and bounds is (left, top, right, bottom) of the area to cover
+        size = self.cell_size
+        key = (tuple((int(goal[0] // size), int(goal[1] // size)) for goal in goals), tuple(tuple(rect) for rect in obstacles))
+        if key == self.key:
+            return
+        self.key = key
+        self.rebuilds += 1
+        self.left, self.top = int(bounds[0] // size), int(bounds[1] // size)
+        self.cols, self.rows = int(bounds[2] // size) - self.left + 1, int(bounds[3] // size) - self.top + 1
+        blocked = np.zeros((self.rows, self.cols), np.bool_)
+        for rect in obstacles:
+            x0, y0 = int((rect[0] - self.margin) // size) - self.left, int((rect[1] - self.margin) // size) - self.top
+            x1, y1 = int((rect[0] + rect[2] + self.margin) // size) - self.left, int((rect[1] + rect[3] + self.margin) // size) - self.top
+            blocked[max(y0, 0):max(y1 + 1, 0), max(x0, 0):max(x1 + 1, 0)] = True
+        #plain lists, a deque and flat indexes are a lot quicker than numpy one cell at a time
+        dist = [-1] * (self.rows * self.cols)
+        open_cells = (~blocked).ravel().tolist()
+        queue = deque()
+        for gx, gy in key[0]:
+            gx, gy = gx - self.left, gy - self.top
+            if 0 <= gx < self.cols and 0 <= gy < self.rows and dist[gy * self.cols + gx] == -1:
+                dist[gy * self.cols + gx] = 0
+                queue.append((gx, gy))
+        while queue:
+            x, y = queue.popleft()
+            step = dist[y * self.cols + x] + 1
+            for ox, oy in self.NEIGHBOURS:
+                nx, ny = x + ox, y + oy
+                if 0 <= nx < self.cols and 0 <= ny < self.rows:
+                    n = ny * self.cols + nx
+                    if dist[n] == -1 and open_cells[n]:
+                        dist[n] = step
+                        queue.append((nx, ny))
+        #each cell's way downhill, cells that can't get anywhere keep (0, 0)
+        dist = np.array(dist).reshape(self.rows, self.cols)
+        padded = np.full((self.rows + 2, self.cols + 2), -1)
+        padded[1:-1, 1:-1] = dist
+        best = np.where(dist > 0, dist, 0)
+        self.hx, self.hy = np.zeros((self.rows, self.cols)), np.zeros((self.rows, self.cols))
+        for ox, oy in self.NEIGHBOURS:
+            near = padded[1 + oy:self.rows + 1 + oy, 1 + ox:self.cols + 1 + ox]
+            closer = (near >= 0) & (near < best)
+            best = np.where(closer, near, best)
+            length = math.hypot(ox, oy)
+            self.hx = np.where(closer, ox / length, self.hx)
+            self.hy = np.where(closer, oy / length, self.hy)
+
+    def sample(self, xs, ys):
+        #the way to go from each point, and whether the field knew one. the goal's own cell, blocked
+        #cells and anything off the grid are left for the caller to sort out
+        cols, rows = (xs // self.cell_size).astype(int) - self.left, (ys // self.cell_size).astype(int) - self.top
+        on_grid = (cols >= 0) & (cols < self.cols) & (rows >= 0) & (rows < self.rows)
+        cols, rows = np.where(on_grid, cols, 0), np.where(on_grid, rows, 0)
+        hx, hy = self.hx[rows, cols], self.hy[rows, cols]
+        found = on_grid & ((hx != 0) | (hy != 0))
+        return hx, hy, found
+
+class FixedStep():
+    #accumulator style fixed timestep. real time piles up in the accumulator and gets spent in
+    #whole ticks, whatever is left over is how far rendering is between the last tick and the next
+    def __init__(self, tick_rate=TICK_RATE, max_steps=5):
+        self.dt = 1 / tick_rate
+        #cap on ticks per frame so one slow frame doesn't snowball into even slower ones
+        self.max_steps = max_steps
+        self.accumulator = 0
+        self.last_time = None
+        self.tick = 0
+
+    def advance(self, now=None):
+        now = time.perf_counter() if now is None else now
+        if self.last_time is None:
+            self.last_time = now
+        self.accumulator += min(now - self.last_time, self.dt * self.max_steps)
+        self.last_time = now
+        steps = int(self.accumulator // self.dt)
+        self.accumulator -= steps * self.dt
+        self.tick += steps
+        return steps
+
+    def get_alpha(self):
+        return self.accumulator / self.dt
+
+class Scheduler():
+    #timers counted in simulation ticks instead of SDL milliseconds, so they are the same every run.
+    #each timer goes in the bucket for the tick it is due on, adding one and firing one are both O(1)
+    #however many are waiting. whatever is in a bucket decides for itself if it is still wanted
+    def __init__(self, tick=0):
+        self.tick = tick
+        self.buckets = {}
+
+    def schedule(self, delay, item):
+        return self.schedule_at(self.tick + delay, item)
+
+    def schedule_at(self, tick, item):
+        self.buckets.setdefault(tick, []).append(item)
+        return tick
+
+    def pop_due(self):
+        return self.buckets.pop(self.tick, ())
+
+    def advance(self):
+        self.tick += 1
+
+class ProfileSection():
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+
+class Profiler():
+    #keeps the last `size` timings of each named section in a ring buffer. when it is off, section()
+    #hands back the same do-nothing context manager every time so the hot paths barely notice
+    NO_SECTION = contextlib.nullcontext()
+
+    def __init__(self, enabled=False, size=300):
+        self.enabled = enabled
+        self.size = size
+        self.samples = {}
+
+    def section(self, name):
+        if not self.enabled:
+            return self.NO_SECTION
+        return ProfileSection(self, name)
+
+    def record(self, name, seconds):
+        if name not in self.samples:
+            self.samples[name] = deque(maxlen=self.size)
+        self.samples[name].append(seconds)
+
+    def get_percentiles(self, name):
+        #p50, p95, p99 in milliseconds
+        ordered = sorted(self.samples[name])
+        return tuple(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000 for p in (0.5, 0.95, 0.99))
+
+    def get_report(self):
+        report = {}
+        for name in self.samples:
+            p50, p95, p99 = self.get_percentiles(name)
+            report[name] = { "count": len(self.samples[name]), "p50_ms": p50, "p95_ms": p95, "p99_ms": p99 }
+        return report
+
+    def get_overlay_lines(self):
+        return ["%-20s %6.2f %6.2f %6.2f" % ((name,) + self.get_percentiles(name)) for name in self.samples]
+
+    def dump(self, path):
+        #json or csv depending on the file name, so runs from two builds can be put side by side
+        report = self.get_report()
+        with open(path, "w", newline="") as f:
+            if path.endswith(".csv"):
+                writer = csv.writer(f)
+                writer.writerow(["section", "count", "p50_ms", "p95_ms", "p99_ms"])
+                for name, row in report.items():
+                    writer.writerow([name, row["count"], row["p50_ms"], row["p95_ms"], row["p99_ms"]])
+            else:
+                json.dump(report, f, indent=2)
+
+#what each quality level keeps, best first. wave_step draws every nth column of waves (0 for none),
+#shrapnel caps the pieces a hit makes, antialias allows --antialias and the dashboard is only
+#redrawn every dashboard_every frames
+QUALITY_LEVELS = [
+    { "wave_step": 1, "shrapnel": 7, "antialias": True, "dashboard_every": 1 },
+    { "wave_step": 1, "shrapnel": 4, "antialias": False, "dashboard_every": 2 },
+    { "wave_step": 2, "shrapnel": 2, "antialias": False, "dashboard_every": 6 },
+    { "wave_step": 0, "shrapnel": 0, "antialias": False, "dashboard_every": 15 },
+]
+
+class QualityGovernor():
+    #watches the average of the last `window` frame times. over budget it drops a quality level,
+    #and only once it has been under recover_below of the budget for `recover` frames in a row does
+    #it go back up, so it doesn't flip between two levels. after any change it waits `settle` frames
+    #for the new level to show in the timings. every change is kept in `changes` with the reason
+    def __init__(self, budget=1 / TICK_RATE, antialias=False, window=30, settle=60, recover=180, recover_below=0.7):
+        self.budget = budget
+        #whether antialiasing was asked for at all, levels can only take it away
+        self.antialias = antialias
+        self.window = deque(maxlen=window)
+        self.settle = settle
+        self.recover = recover
+        self.recover_below = recover_below
+        self.level = 0
+        self.reason = "start"
+        self.changes = deque(maxlen=100)
+        self.frame = 0
+        self.waiting = 0
+        self.under = 0
+
+    def get_settings(self):
+        settings = dict(QUALITY_LEVELS[self.level])
+        settings["antialias"] = settings["antialias"] and self.antialias
+        return settings
+
+    def record(self, seconds):
+        #feed it one frame time, gives back True if the level changed
+        self.frame += 1
+        self.window.append(seconds)
+        if self.waiting:
+            self.waiting -= 1
+            return False
+        if len(self.window) < self.window.maxlen:
+            return False
+        average = sum(self.window) / len(self.window)
+        self.under = self.under + 1 if average < self.budget * self.recover_below else 0
+        if average > self.budget and self.level < len(QUALITY_LEVELS) - 1:
+            return self.set_level(self.level + 1, "average frame %.1fms over the %.1fms budget" % (average * 1000, self.budget * 1000))
+        if self.under >= self.recover and self.level > 0:
+            return self.set_level(self.level - 1, "average frame %.1fms under %.0f%% of the budget for %d frames" %
+                                  (average * 1000, self.recover_below * 100, self.recover))
+        return False
+
+    def set_level(self, level, reason):
+        self.changes.append({ "frame": self.frame, "from": self.level, "to": level, "reason": reason })
+        self.level, self.reason = level, reason
+        self.window.clear()
+        self.waiting, self.under = self.settle, 0
+        return True
+
 ####################################################################
     #TO BE DISPLAYED BEFORE GAME STARTS
 ####################################################################
 
 class Menu():
-    def __init__(self):
+    def __init__(self, high_scores=None):
         #List of menu items
         self.items = ["Play Game", "High Scores"]
         self.item_positions = [(200, 200), (200, 250)]
+        self.hitboxes = [pygame.Rect(position[0], position[1], 200, 35) for position in self.item_positions]
         self.selected = None
+        #index of the item under the mouse, the menu only gets drawn again when this changes
+        self.hovered = None
+        #text is rendered once, the first time the menu is drawn
+        self.title, self.item_surfaces = None, None
+        #a HighScores, the high score screen shows its top list in place of the menu until the next click
+        self.high_scores = high_scores
+        self.showing_scores = False
+        self.score_surfaces = None
+
+    def render(self):
+        self.title = get_font(60).render("Frigate", True, (0,0,0))
+        self.item_surfaces = [get_font(30).render(item, True, (0,0,0)) for item in self.items]
+
+    def render_scores(self):
+        #done when the screen is opened, a handful of lines from the in memory top list
+        lines = ["%2d.  %6d    %s" % (i + 1, score, time.strftime("%Y-%m-%d", time.localtime(when)))
+                 for i, (score, when) in enumerate(self.high_scores.get_top())] if self.high_scores else []
+        self.score_surfaces = [get_font(60).render("High Scores", True, (0,0,0))]
+        self.score_surfaces.extend(get_font(24).render(line, True, (0,0,0)) for line in lines or ["no games yet"])
+        self.score_surfaces.append(get_font(16).render("click to go back", True, (100,100,100)))
 
     def draw(self,screen):
-        screen.blit(font.render("Frigate", True, (0,0,0)), (230, 120))
-        for i, item in enumerate(self.items):
-            menu_item = font_med.render(item, True, (0,0,0) if item == "Play Game" else (100,100,100))
-            screen.blit(menu_item, (self.item_positions[i][0], self.item_positions[i][1]))
-
-    def update(self, screen, mouse_pos):
-        #below loops over menu items, creates a polygon, checks if mouse position is within polygon, if so draws line under selected menu item
-        for i, position in enumerate(self.item_positions):
-            box = Polygon([position, (position[0] + 200, position[1]), (position[0] + 200, position[1] + 35), (position[0], position[1] + 35)])
-            mouse = Point(mouse_pos)
-            if mouse.within(box):
-                if i == 0:
-                    pygame.draw.line(screen, (0,0,0), (position[0], position[1] + 35), (position[0] + 200, position[1] + 35), 3)
-                    self.selected = self.items[i]
-            else:
-                self.selected = None if self.selected == self.items[i] else self.selected
+        if self.showing_scores:
+            self.draw_scores(screen)
+            return
+        if self.title is None:
+            self.render()
+        screen.fill((255,255,255))
+        screen.blit(self.title, (230, 120))
+        for i, item in enumerate(self.item_surfaces):
+            screen.blit(item, self.item_positions[i])
+        #line under the selected menu item
+        if self.hovered is not None:
+            box = self.hitboxes[self.hovered]
+            pygame.draw.line(screen, (0,0,0), box.bottomleft, box.bottomright, 3)
+
+    def draw_scores(self, screen):
+        screen.fill((255,255,255))
+        screen.blit(self.score_surfaces[0], (200, 60))
+        for i, line in enumerate(self.score_surfaces[1:-1]):
+            screen.blit(line, (230, 150 + i * 32))
+        screen.blit(self.score_surfaces[-1], (230, 500))
+
+    def update(self, mouse_pos):
+        #works out which item the mouse is over, gives back True if that changed and the menu needs redrawing
+        hovered = None
+        if not self.showing_scores:
+            for i, box in enumerate(self.hitboxes):
+                if box.collidepoint(mouse_pos):
+                    hovered = i
+        self.selected = self.items[hovered] if hovered is not None else None
+        changed = hovered != self.hovered
+        self.hovered = hovered
+        return changed
 
     def select(self):
-        #starts game if mouse position is within play game button box 
+        #starts game if mouse position is within play game button box, or opens and closes the high scores
         game_started = False
-        if self.selected == "Play Game":
+        if self.showing_scores:
+            self.showing_scores = False
+        elif self.selected == "Play Game":
             game_started = True
-            #print(game_started)
-        else:
-            game_started = False
+        elif self.selected == "High Scores":
+            self.render_scores()
+            self.showing_scores = True
         return game_started
 
 ####################################################################
 ####################################################################
 
-EVENTS = { "ENEMY_RELOAD": pygame.USEREVENT + 1, "USER_RELOAD": pygame.USEREVENT + 2}
+#3 seconds between shots
+RELOAD_TICKS = 3 * TICK_RATE
+
+#draw order, all_sprites is a LayeredUpdates so sprites get slotted into place when they are added
+#instead of the whole group being re-sorted every frame. sink spots go straight after the islands
+#and Projectiles are drawn after all of these
+LAYERS = { "Island": 0, "User": 1, "Enemy": 2 }
+
+class EntityRegistry(pygame.sprite.LayeredUpdates):
+    #all_sprites. on top of the layers it keeps the sprites of each type up to date
+    #as things spawn and despawn so every system only walks over what it actually needs.
+    #dicts are used as ordered sets so everything is still visited in the order it was added
+    def __init__(self, *sprites, **kwargs):
+        self.types = { name: {} for name in LAYERS }
+        #how many entities each system looked at this tick
+        self.touched = {}
+        super().__init__(*sprites, **kwargs)
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        name = sprite.__class__.__name__
+        self.types.setdefault(name, {})[sprite] = None
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        name = sprite.__class__.__name__
+        self.types[name].pop(sprite, None)
+
+    def of_type(self, name):
+        return self.types.get(name, {})
+
+    def touch(self, system, count):
+        self.touched[system] = self.touched.get(system, 0) + count
 
 class Island(pygame.sprite.Sprite):
+    _layer = LAYERS["Island"]
+
     def __init__(self, data):
         super().__init__()
         self.image = pygame.Surface((50,50))
@@ -123,212 +652,468 @@ class Island(pygame.sprite.Sprite):
     def move(self, dx, dy):
         self.rect.move_ip(dx, dy)
 
-    def draw(self, map_surface):
+    def draw(self, map_surface, alpha=1):
         map_surface.blit(self.image, self.rect)
 
-class Shrapnel(pygame.sprite.Sprite):
-    def __init__(self, data):
-        super().__init__()
-        self.start_pos = data["start_pos"]
-        self.contents = []
-        self.is_friendly = data["is_friendly"]
-        self.iter = 0
-
-    def spawn(self, shell_mov_vec):
-        for x in range(0, random.randint(5,7)):
-            self.contents.append({ "pos": self.start_pos,
-                                   "dir": (
-                                       random.random() if shell_mov_vec[0] < 0 else -random.random(),
-                                       random.random() if shell_mov_vec[1] < 0 else -random.random()
-                                       )
-                                   })
-
-    def de_spawn(self, all_sprites):
-        all_sprites.remove(self)
-
-    def move(self, all_sprites):
-        new_contents = []
-        if not self.iter > 10:
-            for x in self.contents:
-                new_contents.append({ "pos": (x["pos"][0] + x["dir"][0], x["pos"][1] + x["dir"][1]),
-                                      "dir": x["dir"] })
-            self.contents = new_contents
-            self.iter += 1
+    def get_dirty_rect(self):
+        return self.rect.copy()
+
+    def get_state(self):
+        return { "type": "Island", "pos": (self.rect.x, self.rect.y) }
+
+    def set_state(self, state):
+        pass
+
+class EntityPool():
+    #things there are lots of and that come and go all the time live in one set of preallocated arrays,
+    #one per field (struct of arrays), instead of one python object each. a whole tick of them is then
+    #a handful of numpy ops. dead slots go on a free list and get handed out again instead of allocating
+    FIELDS = []
+
+    def __init__(self, capacity):
+        self.capacity = 0
+        for name, dtype in self.FIELDS:
+            setattr(self, name, np.zeros(0, dtype))
+        self.free = []
+        self.grow(capacity)
+
+    def grow(self, capacity):
+        for name, dtype in self.FIELDS:
+            new = np.zeros(capacity, dtype)
+            new[:self.capacity] = getattr(self, name)
+            setattr(self, name, new)
+        #reversed so the lowest slots get used first and the live ones stay packed at the front
+        self.free.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+    def take_slot(self):
+        if not self.free:
+            self.grow(self.capacity * 2)
+        return self.free.pop()
+
+    def de_spawn(self, mask):
+        dead = np.flatnonzero(mask)
+        self.alive[dead] = False
+        self.free.extend(dead.tolist())
+
+    def get_state(self):
+        state = { "free": list(self.free) }
+        for name, dtype in self.FIELDS:
+            state[name] = getattr(self, name).copy()
+        return state
+
+    def set_state(self, state):
+        for name, dtype in self.FIELDS:
+            setattr(self, name, state[name].copy())
+        self.capacity = len(self.alive)
+        self.free = list(state["free"])
+
+class SinkSpots(EntityPool):
+    #the rings left where boats went down, they shrink away over a couple of seconds
+    FIELDS = [("x", np.float64), ("y", np.float64), ("radius", np.float64), ("alive", np.bool_)]
+
+    def __init__(self, capacity=16):
+        super().__init__(capacity)
+
+    def add(self, pos):
+        i = self.take_slot()
+        self.x[i], self.y[i] = pos
+        self.radius[i], self.alive[i] = 15.0, True
+        return i
+
+    def step(self):
+        live = self.alive
+        self.radius[live] -= np.where(self.radius[live] > 10, 0.1, 0.2)
+        self.de_spawn(live & (self.radius <= 0))
+
+    def scroll(self, dy):
+        self.y[self.alive] += dy
+
+    def draw(self, map_surface, alpha=1):
+        for x, y, radius in zip(*(field[self.alive].tolist() for field in (self.x, self.y, self.radius))):
+            pygame.draw.circle(map_surface, (255, 255, 255), (x, y), radius)
+            pygame.draw.circle(map_surface, (150,150, 150), (x, y), radius - 3)
+
+    def get_dirty_rects(self):
+        return [pygame.Rect(x - radius - 1, y - radius - 1, radius * 2 + 3, radius * 2 + 3)
+                for x, y, radius in zip(*(field[self.alive].tolist() for field in (self.x, self.y, self.radius)))]
+
+class Projectiles(EntityPool):
+    #every shell and bit of shrapnel
+    SHELL, SHRAPNEL = 0, 1
+    FIELDS = [("x", np.float64), ("y", np.float64), ("prev_x", np.float64), ("prev_y", np.float64),
+              ("dx", np.float64), ("dy", np.float64),
+              ("speed", np.float64), ("age", np.int32), ("kind", np.int8),
+              ("is_friendly", np.bool_), ("alive", np.bool_)]
+
+    def __init__(self, capacity=256, rng=random):
+        #shrapnel is the only random thing in a match, it comes from the game's rng so replays come out the same
+        self.rng = rng
+        #most pieces a hit makes, None for all of them. set by the quality level
+        self.shrapnel_limit = None
+        super().__init__(capacity)
+
+    def add(self, kind, pos, direction, speed, is_friendly):
+        i = self.take_slot()
+        self.x[i], self.y[i] = pos
+        self.prev_x[i], self.prev_y[i] = pos
+        self.dx[i], self.dy[i] = direction
+        self.speed[i], self.age[i], self.kind[i] = speed, 0, kind
+        self.is_friendly[i], self.alive[i] = is_friendly, True
+        return i
+
+    def spawn_shell(self, start_pos, end_pos, is_friendly, firing_speed=5):
+        raw_dx, raw_dy = end_pos[0] - start_pos[0], end_pos[1] - start_pos[1]
+        return self.add(self.SHELL, start_pos, normalize_vector(raw_dx, raw_dy), firing_speed, is_friendly)
+
+    def spawn_shrapnel(self, start_pos, shell_mov_vec, is_friendly):
+        #pieces fly back the way the shell came, their x and y stay at start_pos and only age grows.
+        #pieces over shrapnel_limit still take their numbers from rng so the match plays out the same
+        for x in range(0, self.rng.randint(5,7)):
+            direction = (self.rng.random() if shell_mov_vec[0] < 0 else -self.rng.random(),
+                         self.rng.random() if shell_mov_vec[1] < 0 else -self.rng.random())
+            if self.shrapnel_limit is None or x < self.shrapnel_limit:
+                self.add(self.SHRAPNEL, start_pos, direction, 0, is_friendly)
+
+    def hit_target(self, i, at=None):
+        #turns shell i into shrapnel where it is, or where it hit if that was on the way there
+        at = (self.x[i], self.y[i]) if at is None else at
+        self.spawn_shrapnel(at, (self.dx[i], self.dy[i]), bool(self.is_friendly[i]))
+        self.alive[i] = False
+        self.free.append(i)
+
+    def live_shells(self):
+        return np.flatnonzero(self.alive & (self.kind == self.SHELL))
+
+    def step(self):
+        shells = self.alive & (self.kind == self.SHELL)
+        self.age[shells] += 1
+        #shells slow down as they go and are gone once they drop to 4 or leave the screen
+        speed = self.speed - (self.age / 300 * self.speed)
+        off_screen = (self.x >= SCREEN_WIDTH) | (self.x <= 0) | (self.y >= SCREEN_HEIGHT) | (self.y <= 0)
+        dead = shells & ((speed <= 4) | off_screen)
+        moving = shells & ~dead
+        self.prev_x[:], self.prev_y[:] = self.x, self.y
+        self.x[moving] += self.dx[moving] * speed[moving]
+        self.y[moving] += self.dy[moving] * speed[moving]
+        #shrapnel just grows for 10 ticks
+        shrapnel = self.alive & (self.kind == self.SHRAPNEL)
+        dead |= shrapnel & (self.age > 10)
+        self.age[shrapnel & ~dead] += 1
+        self.de_spawn(dead)
+
+    def draw(self, map_surface, alpha=1):
+        #shells first then shrapnel, same order as before. shells are drawn alpha of the way from
+        #where they were last tick to where they are now
+        for i in self.live_shells().tolist():
+            x = self.prev_x[i] + (self.x[i] - self.prev_x[i]) * alpha
+            y = self.prev_y[i] + (self.y[i] - self.prev_y[i]) * alpha
+            dx, dy = self.dx[i], self.dy[i]
+            pygame.draw.line(map_surface, (255,255,0), (x, y), (x - dx * 4, y - dy * 4), 3)
+        for i in np.flatnonzero(self.alive & (self.kind == self.SHRAPNEL)).tolist():
+            x, y, age = self.x[i], self.y[i], self.age[i]
+            pygame.draw.line(map_surface, (255, 165, 0), (x, y), (x + self.dx[i] * age, y + self.dy[i] * age), 1)
+
+    def get_dirty_rects(self, max_rects=64):
+        #box around each line draw() makes, or one box around the lot once there are too many to bother
+        live = np.flatnonzero(self.alive)
+        if len(live) == 0:
+            return []
+        x, y = self.x[live], self.y[live]
+        #shells trail back 4px, shrapnel reaches out age px
+        length = np.where(self.kind[live] == self.SHELL, -4, self.age[live])
+        end_x, end_y = x + self.dx[live] * length, y + self.dy[live] * length
+        left, top = np.minimum(x, end_x) - 3, np.minimum(y, end_y) - 3
+        right, bottom = np.maximum(x, end_x) + 4, np.maximum(y, end_y) + 4
+        if len(live) > max_rects:
+            return [pygame.Rect(left.min(), top.min(), right.max() - left.min(), bottom.max() - top.min())]
+        return [pygame.Rect(l, t, r - l, b - t) for l, t, r, b in zip(left.tolist(), top.tolist(), right.tolist(), bottom.tolist())]
+
+class BoatArt():
+    #a boat's hull drawn once onto a small surface for each heading, and its turret once for each
+    #angle it can point, so drawing a boat is two blits. they are cached apart because together
+    #there are far too many combinations to keep and a big fleet ended up redrawing every one of them.
+    #angles are rounded to `step` degrees and past `size` hulls the least recently used one is thrown
+    #away, there are only ever 360 / step turrets. antialias can be flipped at any time, it is part of the keys
+    def __init__(self, step=2, size=1024, antialias=False):
+        self.step = step
+        self.size = size
+        self.antialias = antialias
+        self.hulls = OrderedDict()
+        self.turrets = {}
+
+    def get_hull(self, boat):
+        #gives back the picture and where the boat's centre is on it
+        key = (boat.facing, round(boat.cur_turn / self.step) % (360 // self.step), self.antialias)
+        image = self.hulls.get(key)
+        if image is None:
+            image = self.render_hull(boat.hull_shape, boat.hull_center, key[1] * self.step)
+            self.hulls[key] = image
+            if len(self.hulls) > self.size:
+                self.hulls.popitem(last=False)
         else:
-            self.de_spawn(all_sprites)
-
-    def draw(self, map_surface):
-        for piece in self.contents:
-            pygame.draw.line(map_surface,
-                             (255, 165, 0),
-                             self.start_pos,
-                             (self.start_pos[0] + piece["dir"][0] * self.iter, self.start_pos[1] + piece["dir"][1] * self.iter),
-                             1)
-
-class Sink_Spot(pygame.sprite.Sprite):
-    def __init__(self, data):
-        super().__init__()
-        self.position = data["pos"]
-        self.radius = 15.0
-        self.is_friendly = False
-
-    def move(self, all_sprites):
-        self.radius -= 0.1 if self.radius > 10 else 0.2
-        if self.radius <= 0:
-            self.de_spawn(all_sprites)
-
-    def de_spawn(self, all_sprites):
-        all_sprites.remove(self)
-
-    def draw(self, map_surface):
-        pygame.draw.circle(map_surface, (255, 255, 255), self.position, self.radius)
-        pygame.draw.circle(map_surface, (150,150, 150), self.position, self.radius - 3)
-
-class Shell(pygame.sprite.Sprite):
-    def __init__(self, data):
-        super().__init__()
-        self.is_friendly = data
-        self.cur_pos = Point(0,0)
-        self.dx, self.dy = 0, 0
-        self.firing_speed = 5
-        self.iter = 0
-
-    def spawn(self, start_pos, end_pos):
-        self.cur_pos = Point(start_pos)
-        raw_dx, raw_dy = end_pos[0] - self.cur_pos.x, end_pos[1] - self.cur_pos.y
-        normalized_vector = normalize_vector(raw_dx, raw_dy)
-        self.dx, self.dy = normalized_vector[0], normalized_vector[1]
-
-    def de_spawn(self, all_sprites):
-        all_sprites.remove(self)
-
-    def move(self, all_sprites):
-        self.iter += 1
-        speed = self.firing_speed - (self.iter / 300 * self.firing_speed)
-        if speed <= 4 or self.clamp_to_screen():
-            self.de_spawn(all_sprites)
-        self.cur_pos = Point(self.cur_pos.x + self.dx * speed, self.cur_pos.y + self.dy * speed)
-
-    def clamp_to_screen(self):
-        return self.cur_pos.x >= SCREEN_WIDTH or self.cur_pos.x <= 0 or self.cur_pos.y >= SCREEN_HEIGHT or self.cur_pos.y <= 0
-
-    def hit_target(self, all_sprites):
-        shrapnel = Shrapnel({ "start_pos":(self.cur_pos.x, self.cur_pos.y), "is_friendly": self.is_friendly })
-        all_sprites.add(shrapnel)
-        shrapnel.spawn((self.dx, self.dy))
-        self.de_spawn(all_sprites)
-
-    def draw(self, map_surface):
-        pygame.draw.line(map_surface,
-                         (255,255,0),
-                         (self.cur_pos.x, self.cur_pos.y),
-                         ( self.cur_pos.x - self.dx * 4, self.cur_pos.y - self.dy * 4 ),
-                         3)
+            self.hulls.move_to_end(key)
+        return image
+
+    def get_turret(self, turret_angle):
+        key = (round(turret_angle / self.step) % (360 // self.step), self.antialias)
+        if key not in self.turrets:
+            self.turrets[key] = self.render_turret(key[0] * self.step)
+        return self.turrets[key]
+
+    def start_image(self, radius):
+        #square radius either side of the middle. antialiased pictures are drawn 4 times bigger and
+        #smoothscaled down in finish_image
+        scale = 4 if self.antialias else 1
+        if scale > 1:
+            image = pygame.Surface(((radius * 2 + 1) * scale, (radius * 2 + 1) * scale), pygame.SRCALPHA)
+        else:
+            #starts out black and nothing on a boat is black, so black is the see-through colour
+            image = pygame.Surface((radius * 2 + 1, radius * 2 + 1))
+        return image, scale, (radius + 0.5) * scale if scale > 1 else radius
+
+    def finish_image(self, image, scale, radius):
+        if scale > 1:
+            image = pygame.transform.smoothscale(image, (radius * 2 + 1, radius * 2 + 1))
+        #same pixel format as the screen blits a lot faster, if there is a screen yet
+        if pygame.display.get_init() and pygame.display.get_surface():
+            image = image.convert_alpha() if scale > 1 else image.convert()
+        #run length encoding skips the see-through parts in one go, per pixel alpha blits are 10x slower without it
+        if scale > 1:
+            image.set_alpha(255, pygame.RLEACCEL)
+        else:
+            image.set_colorkey((0,0,0), pygame.RLEACCEL)
+        return image, radius
+
+    def render_hull(self, hull_shape, hull_center, heading):
+        #big enough for the hull at any heading, centred on the boat's centre
+        points = [(x - hull_center[0], y - hull_center[1]) for x, y in hull_shape]
+        radius = int(max(math.hypot(x, y) for x, y in points)) + 2
+        image, scale, middle = self.start_image(radius)
+        points = [(middle + x * scale, middle + y * scale) for x, y in rotate_points(points, heading, (0, 0))]
+        pygame.draw.polygon(image, (255,255,255), points)
+        return self.finish_image(image, scale, radius)
+
+    def render_turret(self, turret_angle):
+        #the 15px barrel and its 3px width
+        radius = 19
+        image, scale, middle = self.start_image(radius)
+        angle = math.radians(turret_angle)
+        end = (middle + 15 * scale * math.cos(angle), middle + 15 * scale * math.sin(angle))
+        pygame.draw.circle(image, (150,150,150), (middle, middle), 5 * scale)
+        pygame.draw.line(image, (150,150,150), (middle, middle), end, 3 * scale)
+        return self.finish_image(image, scale, radius)
+
+boat_art = BoatArt()
 
 class Boat(pygame.sprite.Sprite):
+    has_health_bar = False
+    #whether shells hit the hull as it is drawn, turned to cur_turn, or as it was made. the user
+    #has always been hit on the unturned hull, enemies sail any way round so they need the turned one
+    hull_turns = False
+    #everything besides the constructor data that a saved boat needs to carry on where it left off
+    STATE = ("prev_pos", "cur_turn", "turn_by", "movement_dir", "tur_end_pos", "is_reloading", "reload_done_at", "health")
+
     def __init__(self, data):
         super().__init__()
         self.create_hull(data["pos"], data["fwards_or_bwards"])
         self.cur_turn, self.turn_by, self.movement_dir = 0, 0, 0
         self.tur_end_pos = (0,0)
         self.is_reloading = False
+        self.reload_done_at = None
 
-    def set_tur_end_pos(self, center):
-        target_pos = pygame.mouse.get_pos() if self.is_friendly else self.target
+    def set_tur_end_pos(self, center, target_pos=None):
+        if target_pos is None:
+            target_pos = pygame.mouse.get_pos() if self.is_friendly else self.target
         x, y = target_pos[0] - center[0], target_pos[1] - center[1]
-        if x == 0 or y == 0:
-            tur_angle = 0 if x == 0 else math.radians(90 if x > 0 else -90)
-        else:
-            tur_angle = (math.radians(-180) if x <= 0 else 0) + math.atan(y/x)
+        tur_angle = math.atan2(y, x)
         self.tur_end_pos = (center[0] + 15 * math.cos(tur_angle), center[1] + 15 * math.sin(tur_angle))
 
-    def fire(self, all_sprites, target_pos):
-        S1 = Shell(self.is_friendly)
-        S1.spawn(self.tur_end_pos, target_pos)
-        all_sprites.add(S1)
-        self.start_reload()
+    def fire(self, projectiles, timers, target_pos, aim=True):
+        #swing the turret round first, the shell comes out of its end and headless runs never draw it.
+        #enemies have already been aimed by Game.aim_enemies
+        if aim:
+            self.set_tur_end_pos(self.get_center(), target_pos)
+        projectiles.spawn_shell(self.tur_end_pos, target_pos, self.is_friendly)
+        self.start_reload(timers)
 
-    def start_reload(self):
-        RELOAD = pygame.event.Event(EVENTS["ENEMY_RELOAD"], { "id": self.id }) if not self.is_friendly else pygame.event.Event(EVENTS["USER_RELOAD"])
-        pygame.time.set_timer(RELOAD, 3000)
+    def start_reload(self, timers):
         self.is_reloading = True
+        self.reload_done_at = timers.schedule(RELOAD_TICKS, self)
+
+    def finish_reload(self, tick):
+        #called by Game.update when the timer comes due. a boat that fired again since or got
+        #stopped early has moved its reload_done_at on, so an old timer just gets ignored
+        if self.reload_done_at == tick:
+            self.stop_reload()
 
     def stop_reload(self):
-        pygame.time.set_timer(EVENTS["ENEMY_RELOAD"], 0)
         self.is_reloading = False
+        self.reload_done_at = None
 
     def create_hull(self, center: (int,int), facing=-1):
+        #the hull is kept in boat space around (0,0), world coords only get worked out
+        #when something asks for them and are cached until the boat moves or turns
         boat_length, boat_width, stern_length = 50, 15, 13
         if facing == 1:
-            self.hull = Polygon([(center[0] ,center[1]-(boat_length / 2)),
-                                 (center[0] - (boat_width /2), center[1] - (boat_length / 2) + stern_length),
-                                 (center[0] - (boat_width /2), center[1] + (boat_length / 2)),
-                                 (center[0] + (boat_width /2), center[1] + (boat_length / 2)),
-                                 (center[0] + (boat_width /2), center[1] - (boat_length / 2) + stern_length)])
+            shape = [(0, -(boat_length / 2)),
+                     (-(boat_width /2), -(boat_length / 2) + stern_length),
+                     (-(boat_width /2), (boat_length / 2)),
+                     ((boat_width /2), (boat_length / 2)),
+                     ((boat_width /2), -(boat_length / 2) + stern_length)]
         elif facing == -1:
-            self.hull = Polygon([(center[0] ,center[1]+(boat_length / 2)),
-                                 (center[0] + (boat_width /2), center[1] + (boat_length / 2) - stern_length),
-                                 (center[0] + (boat_width /2), center[1] - (boat_length / 2)),
-                                 (center[0] - (boat_width /2), center[1] - (boat_length / 2)),
-                                 (center[0] - (boat_width /2), center[1] + (boat_length / 2) - stern_length)])
+            shape = [(0, (boat_length / 2)),
+                     ((boat_width /2), (boat_length / 2) - stern_length),
+                     ((boat_width /2), -(boat_length / 2)),
+                     (-(boat_width /2), -(boat_length / 2)),
+                     (-(boat_width /2), (boat_length / 2) - stern_length)]
+        #closed ring, same as what shapely handed back
+        self.hull_shape = tuple(shape + shape[:1])
+        self.facing = facing
+        #the centre has always been the average of the closed ring, which leans towards the bow a bit
+        self.hull_center = get_polygon_center(self.hull_shape)
+        self.pos = (center[0], center[1])
+        self.prev_pos = self.pos
+        self.hull_cache, self.hull_cache_key = None, None
+        self.bounds_cache, self.bounds_cache_key = None, None
+        self.draw_cache, self.draw_cache_key = None, None
+
+    def get_hull_coords(self):
+        if self.hull_cache_key != self.pos:
+            self.hull_cache = move_polygon(self.hull_shape, self.pos)
+            self.hull_cache_key = self.pos
+        return self.hull_cache
+
+    def get_draw_coords(self):
+        key = (self.pos, self.cur_turn)
+        if self.draw_cache_key != key:
+            self.draw_cache = rotate_points(self.get_hull_coords(), self.cur_turn, self.get_center())
+            self.draw_cache_key = key
+        return self.draw_cache
+
+    def get_center(self):
+        return (self.pos[0] + self.hull_center[0], self.pos[1] + self.hull_center[1])
+
+    def get_collision_coords(self):
+        #the closed ring shells are tested against, see hull_turns
+        return self.get_draw_coords() if self.hull_turns else self.get_hull_coords()
+
+    def get_bounds(self):
+        key = (self.pos, self.cur_turn) if self.hull_turns else self.pos
+        if self.bounds_cache_key != key:
+            coords = self.get_collision_coords()
+            xs, ys = [c[0] for c in coords], [c[1] for c in coords]
+            self.bounds_cache = (min(xs), min(ys), max(xs), max(ys))
+            self.bounds_cache_key = key
+        return self.bounds_cache
+
+    def get_state(self):
+        state = { "type": self.__class__.__name__, "pos": self.pos, "fwards_or_bwards": self.facing }
+        for name in self.STATE:
+            state[name] = getattr(self, name)
+        return state
+
+    def set_state(self, state):
+        for name in self.STATE:
+            setattr(self, name, state[name])
 
     def take_damage(self):
         self.health -= 10
         return self.health <= 0
 
-    def de_spawn(self, all_sprites):
-        self.sink(all_sprites)
+    def de_spawn(self, all_sprites, sink_spots):
+        self.sink(sink_spots)
         all_sprites.remove(self)
 
-    def sink(self, all_sprites):
-        sink_spot = Sink_Spot({ "pos": get_polygon_center(get_list_from_polygon(self.hull)) })
-        all_sprites.add(sink_spot)
-
-    def draw(self, map_surface):
-        self.draw_hull(map_surface)
-        self.draw_turret(map_surface, get_polygon_center(get_list_from_polygon(self.hull)))
-        if self.__class__.__name__ == "Enemy":
-            self.draw_health_bar(map_surface)
-
-    def draw_hull(self, map_surface):
-        self.hull_poly_coords = rotate_polygon(self.hull, self.cur_turn)
+    def sink(self, sink_spots):
+        sink_spots.add(self.get_center())
+
+    def draw(self, map_surface, alpha=1):
+        #alpha is how far we are between the last tick and the next, the boat gets drawn that far along
+        shift = ((self.pos[0] - self.prev_pos[0]) * (alpha - 1), (self.pos[1] - self.prev_pos[1]) * (alpha - 1))
+        center = self.get_center()
+        turret_angle = math.degrees(math.atan2(self.tur_end_pos[1] - center[1], self.tur_end_pos[0] - center[0]))
+        x, y = round(center[0] + shift[0]), round(center[1] + shift[1])
+        for image, offset in (boat_art.get_hull(self), boat_art.get_turret(turret_angle)):
+            map_surface.blit(image, (x - offset, y - offset))
+        if self.has_health_bar:
+            self.draw_health_bar(map_surface, shift)
+
+    #drawing the hull and turret straight onto the map, what boat_art saves doing every frame
+    def draw_hull(self, map_surface, shift=(0, 0)):
+        self.hull_poly_coords = self.get_draw_coords()
+        if shift[0] != 0 or shift[1] != 0:
+            self.hull_poly_coords = move_polygon(self.hull_poly_coords, shift)
         pygame.draw.polygon(map_surface, (255,255,255), self.hull_poly_coords)
 
-    def draw_turret(self, map_surface, centered_at):
+    def draw_turret(self, map_surface, centered_at, shift=(0, 0)):
+        #the turret is aimed during the update (or once a frame by Game.draw for the user), this only draws it
         center = centered_at
-        self.set_tur_end_pos(center)
         pygame.draw.circle(map_surface, (150,150,150), center, 5)
-        pygame.draw.line(map_surface, (150,150,150), center, self.tur_end_pos, 3)
-
-    def draw_health_bar(self, map_surface):
-        position = get_polygon_center(get_list_from_polygon(self.hull))
-        rect = pygame.Rect(position[0] - 18, position[1] - 29, 7, self.health)
+        pygame.draw.line(map_surface, (150,150,150), center, (self.tur_end_pos[0] + shift[0], self.tur_end_pos[1] + shift[1]), 3)
+
+    def get_dirty_rect(self):
+        #everything draw() can touch, the turret line never reaches past 15px from the centre
+        coords = self.get_draw_coords()
+        xs, ys = [c[0] for c in coords], [c[1] for c in coords]
+        center = self.get_center()
+        rect = pygame.Rect(min(xs), min(ys), max(xs) - min(xs) + 1, max(ys) - min(ys) + 1)
+        rect.union_ip(pygame.Rect(center[0] - 17, center[1] - 17, 35, 35))
+        if self.has_health_bar:
+            rect.union_ip(pygame.Rect(center[0] - 18, center[1] - 29, 7, max(self.health, 0)))
+        return rect.inflate(4, 4)
+
+    def draw_health_bar(self, map_surface, shift=(0, 0)):
+        position = self.get_center()
+        rect = pygame.Rect(position[0] + shift[0] - 18, position[1] + shift[1] - 29, 7, self.health)
         pygame.draw.rect(map_surface, (255,0,0), rect)
 
     def move(self, all_sprites):
-        hull_coords = move_polygon(get_list_from_polygon(self.hull), (0, 0.25))
-        self.hull = Polygon(hull_coords)
+        self.prev_pos = self.pos
+        self.pos = (self.pos[0], self.pos[1] + 0.25)
+
+    def scroll(self, dy):
+        #carried along with the map, on top of whatever the boat does itself
+        self.pos = (self.pos[0], self.pos[1] + dy)
 
 class Enemy(Boat):
+    _layer = LAYERS["Enemy"]
+    has_health_bar = True
+    hull_turns = True
+    STATE = Boat.STATE + ("target",)
+    #px and degrees a tick, and how close they come before sitting and firing
+    speed, turn_rate, hold_range = 0.5, 3, 200
+
     def __init__(self, data):
         super().__init__(data)
         self.is_friendly = False
         self.target = (0,0)
         self.health = 50
         self.id = data["id"]
+        #where Game.steer_enemies wants the boat to go, in the same degrees as cur_turn
+        self.heading = 0
+        self.throttle = 1
 
-    def update(self, user, all_sprites):
-        self.target = user.get_position()
-        self.auto_fire(all_sprites)
+    def get_state(self):
+        state = super().get_state()
+        state["id"] = self.id
+        return state
 
-    def auto_fire(self, all_sprites):
-        ifuckedup = get_polygon_center(get_list_from_polygon(self.hull))
-        var = round(get_vector_length(self.target[0] - ifuckedup[0], self.target[1] - ifuckedup[1]))
-        if var < 300 and not self.is_reloading:
-            self.fire(all_sprites, self.target)
-        
+    def move(self, all_sprites):
+        #swing round towards the heading a few degrees at a time and sail the way the bow points.
+        #a cur_turn of 0 points the bow straight down the screen
+        self.prev_pos = self.pos
+        turn = (self.heading - self.cur_turn + 180) % 360 - 180
+        self.cur_turn += max(-self.turn_rate, min(self.turn_rate, turn))
+        if self.throttle:
+            angle = math.radians(self.cur_turn)
+            self.pos = (self.pos[0] - self.speed * math.sin(angle), self.pos[1] + self.speed * math.cos(angle))
+
+    #aiming and firing are done for every enemy at once in Game.aim_enemies
 
 class User(Boat):
+    _layer = LAYERS["User"]
+
     def __init__(self, data):
         super().__init__(data)
         self.is_friendly = True
@@ -339,8 +1124,8 @@ class User(Boat):
     def get_health(self):
         return self.health
 
-    def mouse_fire(self, all_sprites, mouse_pos):
-        self.fire(all_sprites, mouse_pos)
+    def mouse_fire(self, projectiles, timers, mouse_pos):
+        self.fire(projectiles, timers, mouse_pos)
 
     def start_turn(self, rotation):
         self.turn_by = rotation
@@ -357,15 +1142,16 @@ class User(Boat):
 
     def move(self, all_sprites):
         #TO add accelerate and deccelerate on ship moving
+        self.prev_pos = self.pos
         if (self.turn_by != 0):
             self.cur_turn += self.turn_by / (1 if self.movement_dir > 0 else 2)
         dx = self.movement_dir * 2 *math.sin(math.radians(self.cur_turn)) / (2 if self.movement_dir > 0 else 4)
         dy = -self.movement_dir * 2 *math.cos(math.radians(self.cur_turn)) / (2 if self.movement_dir > 0 else 4)
-        hull_coords = move_polygon(get_list_from_polygon(self.hull), (dx, dy))
-        self.hull = Polygon(hull_coords)
+        if dx != 0 or dy != 0:
+            self.pos = (self.pos[0] + dx, self.pos[1] + dy)
 
     def get_position(self):
-        return get_polygon_center(get_list_from_polygon(self.hull))
+        return self.get_center()
 
     #def hack enemy ship
 
@@ -375,33 +1161,116 @@ class Dashboard():
         self.rect = self.surface.get_rect()
         self.rect.y = 7/8 * SCREEN_HEIGHT
         self.user_health = None
+        #what is currently on self.surface, nothing gets re-rendered until one of these changes
+        self.drawn_health, self.drawn_score = None, None
+        self.score_surface = None
+        #profiler timings shown down the right hand side when profiling is on
+        self.overlay_lines, self.drawn_overlay = [], []
 
     def draw_user_health(self):
         pygame.draw.rect(self.surface, (0,255,0), (10, 10, self.user_health, 20))
 
     def draw_score(self, user_score):
-        scores = font_small.render(str(user_score), True, (0,0,0))
-        self.surface.blit(scores, (10,40))
+        if user_score != self.drawn_score or self.score_surface is None:
+            self.score_surface = get_font(20).render(str(user_score), True, (0,0,0))
+        self.surface.blit(self.score_surface, (10,40))
+
+    def draw_overlay(self):
+        #section name then p50 p95 p99 in ms, in columns of 5 lines
+        for i, line in enumerate(self.overlay_lines):
+            self.surface.blit(get_font(11).render(line, True, (0,0,0)), (180 + (i // 5) * 210, 2 + (i % 5) * 14))
 
     def update(self, user_health):
         self.user_health = user_health
 
-    def draw(self, screen, user_score):
-        screen.blit(self.surface, self.rect)
-        self.surface.fill((255,255,255))
-        self.draw_score(user_score)
-        self.draw_user_health()
+    def draw(self, screen, user_score, force=True):
+        #gives back its rect if the screen needs updating there, force blits it even if nothing changed
+        changed = user_score != self.drawn_score or self.user_health != self.drawn_health or self.overlay_lines != self.drawn_overlay
+        if changed:
+            self.surface.fill((255,255,255))
+            self.draw_score(user_score)
+            self.draw_user_health()
+            self.draw_overlay()
+            self.drawn_score, self.drawn_health, self.drawn_overlay = user_score, self.user_health, self.overlay_lines
+        if changed or force:
+            screen.blit(self.surface, self.rect)
+            return self.rect
+        return None
+
+#the map is made in strips CHUNK_HEIGHT tall as it scrolls. a strip is made once it gets within
+#CHUNK_AHEAD of the top of the map, and anything DESPAWN_BEHIND past the bottom is removed
+CHUNK_HEIGHT = 300
+CHUNK_AHEAD = 300
+DESPAWN_BEHIND = 200
 
 class Game():
     def __init__(self, data):
         self.map_surface = pygame.Surface((data["s_w"], data["s_h"]))
+        #dirty rect mode only redraws what changed, the waves then only drift every wave_refresh frames
+        self.dirty_rects = data.get("dirty_rects", False)
+        self.wave_refresh = data.get("wave_refresh", 30)
+        self.frame = 0
+        self.drawn_offset = None
+        self.prev_rects = []
+        self.profiler = data.get("profiler") or Profiler()
+        #anything random in a match comes from here, so the same seed and inputs give the same match
+        self.seed = data.get("seed")
+        if self.seed is None:
+            self.seed = random.randrange(2 ** 32)
+        self.rng = random.Random(self.seed)
+        #set to a Recorder to have every input event written down
+        self.recorder = None
+        self.tick = 0
+        #reloads and anything else that has to happen a set number of ticks from now
+        self.timers = Scheduler()
         self.rect = self.map_surface.get_rect()
+        #quality settings, see QUALITY_LEVELS
+        self.wave_step = 1
+        self.dashboard_every = 1
         self.dy = 0
         self.progress = 0
-        self.level = 0
+        #the next chunk of map to be made, chunk 0 is the one just above the starting screen
+        self.next_chunk = 0
+        self.next_enemy_id = 1
         self.direction = 0
         self.user_score = 0
         self.wave_iter = 0
+        self.render_waves()
+        self.hulls = SpatialHash()
+        self.projectiles = Projectiles(rng=self.rng)
+        self.sink_spots = SinkSpots()
+        #shared by every enemy to find the way to the user round the islands
+        self.flow = FlowField()
+
+    def get_state(self, all_sprites):
+        #plain python copy of the whole match, cheap enough to take every few seconds
+        return { "tick": self.tick, "dy": self.dy, "progress": self.progress, "next_chunk": self.next_chunk,
+                 "next_enemy_id": self.next_enemy_id, "direction": self.direction, "user_score": self.user_score, "wave_iter": self.wave_iter,
+                 "seed": self.seed, "rng": self.rng.getstate(), "projectiles": self.projectiles.get_state(),
+                 "sink_spots": self.sink_spots.get_state(), "sprites": [sprite.get_state() for sprite in all_sprites] }
+
+    def set_state(self, state, all_sprites):
+        #puts a match back the way get_state found it, all_sprites gets refilled and the new user is returned
+        for name in ("tick", "dy", "progress", "next_chunk", "next_enemy_id", "direction", "user_score", "wave_iter", "seed"):
+            setattr(self, name, state[name])
+        self.rng.setstate(state["rng"])
+        self.projectiles.set_state(state["projectiles"])
+        self.sink_spots.set_state(state["sink_spots"])
+        #everything may have moved, so dirty rect mode starts again from a full redraw
+        self.drawn_offset = None
+        all_sprites.empty()
+        #the timers only ever hold boats waiting on a reload, so they are rebuilt from the boats
+        self.timers = Scheduler(self.tick)
+        user = None
+        for sprite_state in state["sprites"]:
+            sprite = SPRITE_TYPES[sprite_state["type"]](sprite_state)
+            sprite.set_state(sprite_state)
+            all_sprites.add(sprite)
+            if sprite_state.get("reload_done_at") is not None:
+                self.timers.schedule_at(sprite_state["reload_done_at"], sprite)
+            if sprite_state["type"] == "User":
+                user = sprite
+        return user
 
     def handle_key_down(self, event, user):
         if event.unicode == 'w':
@@ -428,153 +1297,672 @@ class Game():
         if event.unicode == 'd' and user.turn_by != 0:
             user.end_turn()
 
-    def draw_waves(self):
-        nwavesx = 12
-        nwavesy = 10
-        #get some wavey action
-        for y in range(0, int(SCREEN_HEIGHT * 7/8 / nwavesy)):
-            for x in range(0, int(SCREEN_WIDTH / nwavesx)):
-                #pygame.draw.arc(self.map_surface, (255,255,255), (x * 64, y * 48, 8, 6), 0.1, 0.9, 1)
-                pygame.draw.arc(self.map_surface, (200,200,200), (32 + self.wave_iter + x * 64 + 2 - 10, 24 + y * 48 + 10, 8, 6), 1, 3, 1)
+    def set_quality(self, settings):
+        #takes one of QUALITY_LEVELS, as handed out by QualityGovernor.get_settings
+        if settings["wave_step"] != self.wave_step:
+            self.wave_step = settings["wave_step"]
+            self.render_waves()
+            #a different sea means the whole map has to go back on screen in dirty rect mode
+            self.drawn_offset = None
+        self.projectiles.shrapnel_limit = settings["shrapnel"]
+        boat_art.antialias = settings["antialias"]
+        self.dashboard_every = settings["dashboard_every"]
+
+    def render_waves(self):
+        #the waves repeat every 64px across and 48px down, so the sea is drawn once onto a surface
+        #one tile bigger than the map and then just blitted at an offset every frame.
+        #the first 64px column is left empty since waves only ever drift right from x = 24.
+        #lower quality levels only draw every wave_step-th column, or none at all
+        tile_w, tile_h = 64, 48
+        self.wave_surface = pygame.Surface((self.rect.width + tile_w, self.rect.height + tile_h))
+        self.wave_surface.fill((0,0,255))
+        if not self.wave_step:
+            return
+        for y in range(0, self.wave_surface.get_height() // tile_h + 1):
+            for x in range(0, self.wave_surface.get_width() // tile_w, self.wave_step):
+                pygame.draw.arc(self.wave_surface, (200,200,200), (tile_w + 24 + x * tile_w, 34 + y * tile_h, 8, 6), 1, 3, 1)
+
+    def get_wave_offset(self):
+        #waves drift with wave_iter and scroll down with the map
+        return (int(self.wave_iter) - 64, int(self.progress) % 48 - 48)
+
+    def step_waves(self):
         self.wave_iter = self.wave_iter + 0.5 if self.wave_iter < 50 else 0
 
-    def draw(self, screen, all_sprites, dashboard):
-        self.map_surface.fill((0,0,255))
-        self.draw_waves()
-        #draw sprites
-        for sprite in all_sprites:
-             sprite.draw(self.map_surface)
-        #put map on screen
-        screen.blit(self.map_surface, self.rect)
-        dashboard.draw(screen, self.user_score)
-        
+    def handle_event(self, event, all_sprites, user):
+        #everything that can happen to a match from input, main() and run_headless() both feed events through here
+        if self.recorder:
+            self.recorder.record(self.tick, event)
+
+        if event.type == pygame.KEYDOWN:
+            self.handle_key_down(event, user)
+
+        if event.type == pygame.KEYUP:
+            self.handle_key_up(event, user)
+
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            user.mouse_fire(self.projectiles, self.timers, event.pos)
+
+    def draw_waves(self):
+        #get some wavey action
+        self.map_surface.blit(self.wave_surface, self.get_wave_offset())
+
+    def draw(self, screen, all_sprites, dashboard, alpha=1):
+        #gives back the list of rects that need updating on screen, or None for the whole thing.
+        #alpha is how far between two ticks this frame is, for smoothing out movement
+        self.frame += 1
+        #the mouse is read once a frame and only the user's turret follows it
+        mouse_pos = pygame.mouse.get_pos()
+        for user in all_sprites.of_type("User"):
+            user.set_tur_end_pos(user.get_center(), mouse_pos)
+        if self.profiler.enabled and self.frame % 30 == 0:
+            dashboard.overlay_lines = self.profiler.get_overlay_lines()
+        if self.dirty_rects:
+            return self.draw_dirty(screen, all_sprites, dashboard)
+        with self.profiler.section("draw.waves"):
+            self.draw_waves()
+        #draw sprites, all_sprites already hands them back layer by layer. whatever is off the map is skipped
+        with self.profiler.section("draw.sprites"):
+            map_rect = self.map_surface.get_rect()
+            for name in LAYERS:
+                for sprite in all_sprites.of_type(name):
+                    if sprite.get_dirty_rect().colliderect(map_rect):
+                        sprite.draw(self.map_surface, alpha)
+                if name == "Island":
+                    self.sink_spots.draw(self.map_surface, alpha)
+            self.projectiles.draw(self.map_surface, alpha)
+            #put map on screen
+            screen.blit(self.map_surface, self.rect)
+        with self.profiler.section("draw.dashboard"):
+            if self.frame % self.dashboard_every == 0:
+                dashboard.draw(screen, self.user_score)
+        return None
+
+    def draw_dirty(self, screen, all_sprites, dashboard):
+        #no in-between tick smoothing here, the dirty rects are worked out from where things really are
+        offset = self.get_wave_offset()
+        #the drawn sea only catches up with wave_iter every wave_refresh frames, or straight away if the map scrolled
+        if self.drawn_offset is not None and offset[1] == self.drawn_offset[1] and self.frame % self.wave_refresh != 0:
+            offset = self.drawn_offset
+        #the whole sea has to be redrawn when it moved, otherwise only where sprites were last frame
+        full = offset != self.drawn_offset
+        with self.profiler.section("draw.waves"):
+            if full:
+                self.map_surface.blit(self.wave_surface, offset)
+                self.drawn_offset = offset
+            else:
+                for rect in self.prev_rects:
+                    self.map_surface.blit(self.wave_surface, rect, rect.move(-offset[0], -offset[1]))
+        with self.profiler.section("draw.sprites"):
+            rects = []
+            map_rect = self.map_surface.get_rect()
+            for name in LAYERS:
+                for sprite in all_sprites.of_type(name):
+                    rect = sprite.get_dirty_rect()
+                    if rect.colliderect(map_rect):
+                        sprite.draw(self.map_surface)
+                        rects.append(rect)
+                if name == "Island":
+                    self.sink_spots.draw(self.map_surface)
+                    rects.extend(self.sink_spots.get_dirty_rects())
+            self.projectiles.draw(self.map_surface)
+            rects.extend(self.projectiles.get_dirty_rects())
+            dirty = [rect.clip(map_rect) for rect in rects + self.prev_rects]
+            self.prev_rects = rects
+            if full:
+                screen.blit(self.map_surface, self.rect)
+                updates = [self.rect]
+            else:
+                updates = []
+                for rect in dirty:
+                    if rect.width and rect.height:
+                        screen.blit(self.map_surface, rect.move(self.rect.topleft), rect)
+                        updates.append(rect.move(self.rect.topleft))
+        with self.profiler.section("draw.dashboard"):
+            dash_rect = dashboard.draw(screen, self.user_score, force=full) if full or self.frame % self.dashboard_every == 0 else None
+        if dash_rect:
+            updates.append(dash_rect)
+        return updates
 
     def handle_shells(self, all_sprites, user):
-        for sprite in all_sprites:
-            if sprite.__class__.__name__ == "Shell":
-                for spriteT in all_sprites:
-                    if spriteT.__class__.__name__ == "Enemy" and sprite.is_friendly:
-                        if sprite.cur_pos.within(spriteT.hull):
-                            sprite.hit_target(all_sprites)
-                            has_died = spriteT.take_damage()
-                            if has_died:
-                                spriteT.de_spawn(all_sprites)
-                                self.user_score += 5
-                    elif spriteT.__class__.__name__ == "User" and not sprite.is_friendly:
-                        if sprite.cur_pos.within(spriteT.hull):
-                            sprite.hit_target(all_sprites)
-                            has_died = spriteT.take_damage()
-
-    
+        #rebuild the grid of boat hulls every tick, then every shell is swept from where it was last tick
+        #to where it is now. only the hulls sharing a cell with that path get the exact test, which gives
+        #back how far along the path the shell hit so fast shells can't skip through a boat between ticks
+        self.hulls.clear()
+        for name in ("Enemy", "User"):
+            for sprite in all_sprites.of_type(name):
+                self.hulls.insert(sprite, sprite.get_bounds())
+        shells = self.projectiles.live_shells()
+        all_sprites.touch("handle_shells", len(all_sprites.of_type("Enemy")) + len(all_sprites.of_type("User")) + len(shells))
+        if len(shells) == 0:
+            return
+        size = self.hulls.cell_size
+        xs, ys = self.projectiles.x[shells], self.projectiles.y[shells]
+        pxs, pys = self.projectiles.prev_x[shells], self.projectiles.prev_y[shells]
+        low_x, high_x = (np.minimum(xs, pxs) // size).astype(int).tolist(), (np.maximum(xs, pxs) // size).astype(int).tolist()
+        low_y, high_y = (np.minimum(ys, pys) // size).astype(int).tolist(), (np.maximum(ys, pys) // size).astype(int).tolist()
+        cells = {}
+        for n, (x0, x1, y0, y1) in enumerate(zip(low_x, high_x, low_y, high_y)):
+            #nearly every path stays inside one cell
+            if x0 == x1 and y0 == y1:
+                if (x0, y0) in self.hulls.cells:
+                    cells.setdefault((x0, y0), []).append(n)
+                continue
+            for key in itertools.product(range(x0, x1 + 1), range(y0, y1 + 1)):
+                if key in self.hulls.cells:
+                    cells.setdefault(key, []).append(n)
+        xl, yl, pxl, pyl = xs.tolist(), ys.tolist(), pxs.tolist(), pys.tolist()
+        friendly = self.projectiles.is_friendly[shells].tolist()
+        #each shell only hits the first hull along its path
+        first = {}
+        for key, in_cell in cells.items():
+            for spriteT in self.hulls.cells[key]:
+                #shells only hurt the other side
+                candidates = [n for n in in_cell if friendly[n] != spriteT.is_friendly]
+                coords = spriteT.get_collision_coords()
+                #numpy only pays off once a cell gets crowded
+                if len(candidates) > 16:
+                    candidates = np.array(candidates)
+                    times = segments_hit_polygon(pxs[candidates], pys[candidates], xs[candidates], ys[candidates], coords)
+                    hits = [(n, t) for n, t in zip(candidates.tolist(), times.tolist()) if t != np.inf]
+                else:
+                    #anything whose path misses the hull's bounding box can't hit it
+                    minx, miny, maxx, maxy = spriteT.get_bounds()
+                    hits = [(n, segment_hits_polygon(pxl[n], pyl[n], xl[n], yl[n], coords)) for n in candidates
+                            if max(xl[n], pxl[n]) >= minx and min(xl[n], pxl[n]) <= maxx and max(yl[n], pyl[n]) >= miny and min(yl[n], pyl[n]) <= maxy]
+                for n, t in hits:
+                    if t is not None and (n not in first or t < first[n][0]):
+                        first[n] = (t, spriteT)
+        for n in sorted(first):
+            t, spriteT = first[n]
+            #a boat sunk by an earlier shell this tick
+            if not spriteT.alive():
+                continue
+            self.projectiles.hit_target(int(shells[n]), (pxl[n] + (xl[n] - pxl[n]) * t, pyl[n] + (yl[n] - pyl[n]) * t))
+            has_died = spriteT.take_damage()
+            if has_died and not spriteT.is_friendly:
+                spriteT.de_spawn(all_sprites, self.sink_spots)
+                self.user_score += 5
 
     def scroll_map(self, all_sprites):
         if self.dy != 0:
             self.progress -= self.dy
-            for sprite in all_sprites:
-                if sprite.__class__.__name__ == "Island":
-                    sprite.move(0, -self.dy)
-        if self.progress >= 100 and self.level == 0:
-            I1 = Island({ "pos": (0,0) })
-            all_sprites.add(I1)
-            self.level += 1
-                            
+            islands = all_sprites.of_type("Island")
+            all_sprites.touch("scroll_map", len(islands))
+            for sprite in islands:
+                sprite.move(0, -self.dy)
+            #enemies and sink spots are on the map too, only the user stays put on screen
+            enemies = all_sprites.of_type("Enemy")
+            all_sprites.touch("scroll_map", len(enemies))
+            for sprite in enemies:
+                sprite.scroll(-self.dy)
+            self.sink_spots.scroll(-self.dy)
+
+    def stream_world(self, all_sprites):
+        #chunk n covers from progress - n * CHUNK_HEIGHT on screen upwards, so new ones are made as the map scrolls
+        while self.progress - self.next_chunk * CHUNK_HEIGHT > -CHUNK_AHEAD:
+            self.generate_chunk(all_sprites, self.next_chunk)
+            self.next_chunk += 1
+        #things only leave by drifting or scrolling down, a couple of times a second is plenty to catch them
+        if self.tick % 30 != 0:
+            return
+        limit = self.rect.height + DESPAWN_BEHIND
+        self.sink_spots.de_spawn(self.sink_spots.alive & (self.sink_spots.y - self.sink_spots.radius - 1 > limit))
+        for name in ("Island", "Enemy"):
+            sprites = all_sprites.of_type(name)
+            all_sprites.touch("stream_world", len(sprites))
+            gone = [sprite for sprite in sprites if sprite.get_dirty_rect().top > limit]
+            all_sprites.remove(*gone)
+
+    def generate_chunk(self, all_sprites, index):
+        #a chunk only depends on the seed and its number, not on self.rng, so it comes out the
+        #same whenever it gets made. there are more enemies the further in it is
+        rng = random.Random("%d:%d" % (self.seed, index))
+        bottom = self.progress - index * CHUNK_HEIGHT
+        for i in range(rng.randint(0, 2)):
+            all_sprites.add(Island({ "pos": (rng.randint(0, self.rect.width - 50), int(bottom) - rng.randint(50, CHUNK_HEIGHT)) }))
+        for i in range(rng.randint(0, min(1 + index // 4, 4))):
+            all_sprites.add(Enemy({ "pos": (rng.uniform(50, self.rect.width - 50), bottom - rng.uniform(25, CHUNK_HEIGHT - 25)),
+                                    "fwards_or_bwards": -1, "id": self.next_enemy_id }))
+            self.next_enemy_id += 1
+
 
     def update(self, all_sprites, user, dashboard):
+        all_sprites.touched = {}
+        for boat in self.timers.pop_due():
+            boat.finish_reload(self.tick)
         dashboard.update(user.get_health())
         if user.get_position()[1] < SCREEN_HEIGHT / 2 and user.movement_dir == -1:
                 self.dy -= 1
-        self.scroll_map(all_sprites)
-        self.handle_shells(all_sprites, user)
-        for sprite in all_sprites:
-            if not sprite.__class__.__name__ == "Island":
-                sprite.move(all_sprites)
-            if not sprite.is_friendly:
-                #print(sprite.__class__ == '.Boat')
-                sprite.update(user, all_sprites)
-                #sprite.fire(all_sprites, user.get_position())
+        with self.profiler.section("update.scroll_map"):
+            self.scroll_map(all_sprites)
+            self.stream_world(all_sprites)
+        self.step_waves()
+        with self.profiler.section("update.handle_shells"):
+            self.handle_shells(all_sprites, user)
+        with self.profiler.section("update.projectiles"):
+            self.projectiles.step()
+        all_sprites.touch("projectiles", int(self.projectiles.alive.sum()))
+        with self.profiler.section("update.navigation"):
+            self.steer_enemies(all_sprites)
+        self.sink_spots.step()
+        all_sprites.touch("sink_spots", int(self.sink_spots.alive.sum()))
+        #islands only move with the map, the boats move themselves
+        for name in ("User", "Enemy"):
+            with self.profiler.section("update.move " + name):
+                sprites = list(all_sprites.of_type(name))
+                all_sprites.touch("move " + name, len(sprites))
+                for sprite in sprites:
+                    sprite.move(all_sprites)
+        with self.profiler.section("update.enemy_ai"):
+            self.aim_enemies(all_sprites)
+        self.tick += 1
+        self.timers.advance()
+
+    def get_targets(self, all_sprites, centers):
+        #where the nearest user is from each of centers, with more than one player the fleet splits up between them
+        targets = np.array([user.get_position() for user in all_sprites.of_type("User")])
+        if len(targets) == 1:
+            return targets[0, 0], targets[0, 1]
+        nearest = np.argmin(np.hypot(targets[:, 0] - centers[:, 0, None], targets[:, 1] - centers[:, 1, None]), axis=1)
+        return targets[nearest, 0], targets[nearest, 1]
+
+    def steer_enemies(self, all_sprites):
+        #the flow field is kept in map coordinates, which don't change as the map scrolls, so it only
+        #gets worked out again when a user changes cell or islands come and go. it covers all the
+        #way from where chunks are made down to where things get despawned
+        enemies = list(all_sprites.of_type("Enemy"))
+        all_sprites.touch("navigation", len(enemies))
+        if not enemies or not all_sprites.of_type("User"):
+            return
+        goals = [(x, y - self.progress) for x, y in (user.get_position() for user in all_sprites.of_type("User"))]
+        islands = [(rect.x, rect.y - self.progress, rect.width, rect.height) for rect in (island.rect for island in all_sprites.of_type("Island"))]
+        self.flow.update(goals, islands,
+                         (0, -CHUNK_AHEAD - CHUNK_HEIGHT - self.progress, self.rect.width, self.rect.height + DESPAWN_BEHIND - self.progress))
+        centers = np.array([enemy.get_center() for enemy in enemies])
+        hx, hy, found = self.flow.sample(centers[:, 0], centers[:, 1] - self.progress)
+        #straight at the nearest user from off the grid or once in the same cell
+        goal_x, goal_y = self.get_targets(all_sprites, centers)
+        dx, dy = goal_x - centers[:, 0], goal_y - centers[:, 1]
+        hx, hy = np.where(found, hx, dx), np.where(found, hy, dy)
+        headings = np.degrees(np.arctan2(-hx, hy))
+        holding = np.hypot(dx, dy) < Enemy.hold_range
+        for enemy, heading, hold in zip(enemies, headings.tolist(), holding.tolist()):
+            enemy.heading = heading
+            enemy.throttle = 0 if hold else 1
+
+    def aim_enemies(self, all_sprites):
+        #the whole fleet in one go: distance and turret angle from every enemy to the nearest user in a
+        #few numpy ops, then whoever is in range and loaded fires
+        enemies = list(all_sprites.of_type("Enemy"))
+        all_sprites.touch("enemy_ai", len(enemies))
+        if not enemies or not all_sprites.of_type("User"):
+            return
+        centers = np.array([enemy.get_center() for enemy in enemies])
+        target_x, target_y = self.get_targets(all_sprites, centers)
+        dx, dy = target_x - centers[:, 0], target_y - centers[:, 1]
+        angles = np.arctan2(dy, dx)
+        tur_x, tur_y = centers[:, 0] + 15 * np.cos(angles), centers[:, 1] + 15 * np.sin(angles)
+        in_range = np.round(np.hypot(dx, dy)) < 300
+        targets = zip(np.broadcast_to(target_x, len(enemies)).tolist(), np.broadcast_to(target_y, len(enemies)).tolist())
+        for enemy, x, y, fire, target in zip(enemies, tur_x.tolist(), tur_y.tolist(), in_range.tolist(), targets):
+            enemy.target = target
+            enemy.tur_end_pos = (x, y)
+            if fire and not enemy.is_reloading:
+                enemy.fire(self.projectiles, self.timers, target, aim=False)
         
 
-def order_all_sprites(all_sprites):
-    order =["Island", "Sink_Spot", "User", "Enemy", "Shell", "Shrapnel"]
-    new_all_sprites = pygame.sprite.Group()
-    for i in order:
-        for sprite in all_sprites:
-            if sprite.__class__.__name__ == i:
-                new_all_sprites.add(sprite)
-    return new_all_sprites
-
-def main():
-    
-    disp_icon()
+SPRITE_TYPES = { "Island": Island, "User": User, "Enemy": Enemy }
+
+####################################################################
+    #REPLAYS
+####################################################################
+
+#a replay file is a header then one record per event, all little endian:
+#  header: magic, format version, seed, enemies at the start, ticks played
+#  record: tick, event kind, then a key code or a mouse position depending on the kind
+#version 2 dropped the reload records, reloads are timed inside the simulation now
+REPLAY_MAGIC, REPLAY_VERSION = b"FRG2", 2
+REPLAY_HEADER = struct.Struct("<4sHQHI")
+REPLAY_RECORD = struct.Struct("<IB")
+REPLAY_KEY_DOWN, REPLAY_KEY_UP, REPLAY_FIRE = 1, 2, 3
+REPLAY_PAYLOADS = { REPLAY_KEY_DOWN: struct.Struct("<I"), REPLAY_KEY_UP: struct.Struct("<I"),
+                    REPLAY_FIRE: struct.Struct("<hh") }
+
+class Recorder():
+    def __init__(self, seed, n_enemies):
+        self.seed = seed
+        self.n_enemies = n_enemies
+        self.events = []
+
+    def record(self, tick, event):
+        #only the events that change the match, in the order they were handled
+        if event.type == pygame.KEYDOWN or event.type == pygame.KEYUP:
+            kind = REPLAY_KEY_DOWN if event.type == pygame.KEYDOWN else REPLAY_KEY_UP
+            self.events.append((tick, kind, (ord(event.unicode) if len(event.unicode) == 1 else 0,)))
+        elif event.type == pygame.MOUSEBUTTONDOWN:
+            self.events.append((tick, REPLAY_FIRE, (int(event.pos[0]), int(event.pos[1]))))
+
+    def save(self, path, ticks):
+        with open(path, "wb") as f:
+            f.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, self.seed, self.n_enemies, ticks))
+            for tick, kind, payload in self.events:
+                f.write(REPLAY_RECORD.pack(tick, kind))
+                f.write(REPLAY_PAYLOADS[kind].pack(*payload))
+
+class Replay():
+    #plays a recorded match back through the normal simulation with no window. a snapshot of the
+    #whole match is kept every snapshot_every ticks so seek() never has to start from the beginning
+    def __init__(self, path, snapshot_every=TICK_RATE * 10):
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, self.seed, self.n_enemies, self.ticks = REPLAY_HEADER.unpack_from(data)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError("%s is not a version %d replay" % (path, REPLAY_VERSION))
+        self.events = []
+        offset = REPLAY_HEADER.size
+        while offset < len(data):
+            tick, kind = REPLAY_RECORD.unpack_from(data, offset)
+            offset += REPLAY_RECORD.size
+            self.events.append((tick, kind, REPLAY_PAYLOADS[kind].unpack_from(data, offset)))
+            offset += REPLAY_PAYLOADS[kind].size
+        self.event_ticks = [event[0] for event in self.events]
+        self.snapshot_every = snapshot_every
+        self.snapshots = {}
+        self.restart()
+
+    def restart(self):
+        self.G1, self.dashboard, self.all_sprites, self.user = new_game(self.n_enemies, seed=self.seed)
+        self.next_event = 0
+
+    def to_event(self, kind, payload):
+        if kind == REPLAY_KEY_DOWN or kind == REPLAY_KEY_UP:
+            return pygame.event.Event(pygame.KEYDOWN if kind == REPLAY_KEY_DOWN else pygame.KEYUP, unicode=chr(payload[0]) if payload[0] else "")
+        return pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=payload, button=1)
+
+    def step(self):
+        #one tick: whatever was handled before this tick in the recording, then the update itself
+        while self.next_event < len(self.events) and self.events[self.next_event][0] <= self.G1.tick:
+            tick, kind, payload = self.events[self.next_event]
+            self.G1.handle_event(self.to_event(kind, payload), self.all_sprites, self.user)
+            self.next_event += 1
+        self.G1.update(self.all_sprites, self.user, self.dashboard)
+        if self.G1.tick % self.snapshot_every == 0:
+            self.snapshots[self.G1.tick] = pack_state(self.G1.get_state(self.all_sprites))
+
+    def seek(self, tick):
+        #jump to the latest snapshot at or before tick, or the start, and fast forward from there
+        tick = min(tick, self.ticks)
+        taken = [t for t in self.snapshots if t <= tick]
+        if taken and (max(taken) > self.G1.tick or self.G1.tick > tick):
+            self.user = self.G1.set_state(unpack_state(self.snapshots[max(taken)]), self.all_sprites)
+            self.next_event = bisect.bisect_left(self.event_ticks, self.G1.tick)
+        elif self.G1.tick > tick:
+            self.restart()
+        while self.G1.tick < tick:
+            self.step()
+
+    def play(self, speed=0):
+        #speed is a multiple of real time, 0 means as fast as the cpu goes
+        start, start_tick = time.perf_counter(), self.G1.tick
+        while self.G1.tick < self.ticks:
+            self.step()
+            if speed:
+                ahead = (self.G1.tick - start_tick) / (TICK_RATE * speed) - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+####################################################################
+    #SNAPSHOTS
+####################################################################
+
+#a snapshot is Game.get_state packed into bytes, all little endian:
+#  header: magic, format version, then the game's own numbers
+#  rng: the Mersenne Twister state and the spare gauss if there is one
+#  pools: projectiles then sink spots, each capacity, free list and then every field array whole
+#  sprites: how many, then a kind byte and a fixed size record each, in draw order
+#the reload timers aren't written, Game.set_state rebuilds them from the boats
+SNAPSHOT_MAGIC, SNAPSHOT_VERSION = b"FRGS", 1
+SNAPSHOT_HEADER = struct.Struct("<4sHQIidIIiid")
+SNAPSHOT_RNG = struct.Struct("<B625IBd")
+SNAPSHOT_POOL = struct.Struct("<II")
+SNAPSHOT_COUNT = struct.Struct("<I")
+SNAPSHOT_KIND = struct.Struct("<B")
+SNAPSHOT_ISLAND, SNAPSHOT_USER, SNAPSHOT_ENEMY = 0, 1, 2
+SNAPSHOT_KINDS = { "Island": SNAPSHOT_ISLAND, "User": SNAPSHOT_USER, "Enemy": SNAPSHOT_ENEMY }
+#island: position. boat: id, facing, pos, prev_pos, cur_turn, turn_by, movement_dir, tur_end_pos,
+#is_reloading, reload_done_at (-1 for none), health, target. the user has no id or target so those are 0
+SNAPSHOT_RECORDS = { SNAPSHOT_ISLAND: struct.Struct("<ii"), SNAPSHOT_USER: struct.Struct("<Ib4dddb2dBqi2d") }
+SNAPSHOT_RECORDS[SNAPSHOT_ENEMY] = SNAPSHOT_RECORDS[SNAPSHOT_USER]
+
+def pack_pool(state, fields):
+    parts = [SNAPSHOT_POOL.pack(len(state["alive"]), len(state["free"])), np.array(state["free"], np.uint32).tobytes()]
+    parts.extend(state[name].tobytes() for name, dtype in fields)
+    return b"".join(parts)
+
+def unpack_pool(data, offset, fields):
+    capacity, n_free = SNAPSHOT_POOL.unpack_from(data, offset)
+    offset += SNAPSHOT_POOL.size
+    state = { "free": np.frombuffer(data, np.uint32, n_free, offset).tolist() }
+    offset += n_free * 4
+    for name, dtype in fields:
+        state[name] = np.frombuffer(data, dtype, capacity, offset).copy()
+        offset += state[name].nbytes
+    return state, offset
+
+def pack_state(state):
+    rng_version, rng_words, gauss = state["rng"]
+    parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, state["seed"], state["tick"], state["dy"], state["progress"],
+                                  state["next_chunk"], state["next_enemy_id"], state["direction"], state["user_score"], state["wave_iter"]),
+             SNAPSHOT_RNG.pack(rng_version, *rng_words, gauss is not None, gauss or 0),
+             pack_pool(state["projectiles"], Projectiles.FIELDS), pack_pool(state["sink_spots"], SinkSpots.FIELDS),
+             SNAPSHOT_COUNT.pack(len(state["sprites"]))]
+    for sprite in state["sprites"]:
+        kind = SNAPSHOT_KINDS[sprite["type"]]
+        parts.append(SNAPSHOT_KIND.pack(kind))
+        if kind == SNAPSHOT_ISLAND:
+            parts.append(SNAPSHOT_RECORDS[kind].pack(*sprite["pos"]))
+            continue
+        reload_done_at = -1 if sprite["reload_done_at"] is None else sprite["reload_done_at"]
+        parts.append(SNAPSHOT_RECORDS[kind].pack(sprite.get("id", 0), sprite["fwards_or_bwards"], *sprite["pos"], *sprite["prev_pos"],
+                                                 sprite["cur_turn"], sprite["turn_by"], sprite["movement_dir"], *sprite["tur_end_pos"],
+                                                 sprite["is_reloading"], reload_done_at, sprite["health"], *sprite.get("target", (0, 0))))
+    return b"".join(parts)
+
+def unpack_state(data):
+    (magic, version, seed, tick, dy, progress, next_chunk, next_enemy_id, direction,
+     user_score, wave_iter) = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError("not a version %d snapshot" % SNAPSHOT_VERSION)
+    state = { "seed": seed, "tick": tick, "dy": dy, "progress": progress, "next_chunk": next_chunk, "next_enemy_id": next_enemy_id,
+              "direction": direction, "user_score": user_score, "wave_iter": wave_iter, "sprites": [] }
+    offset = SNAPSHOT_HEADER.size
+    rng = SNAPSHOT_RNG.unpack_from(data, offset)
+    state["rng"] = (rng[0], tuple(rng[1:626]), rng[627] if rng[626] else None)
+    offset += SNAPSHOT_RNG.size
+    state["projectiles"], offset = unpack_pool(data, offset, Projectiles.FIELDS)
+    state["sink_spots"], offset = unpack_pool(data, offset, SinkSpots.FIELDS)
+    count, = SNAPSHOT_COUNT.unpack_from(data, offset)
+    offset += SNAPSHOT_COUNT.size
+    for i in range(count):
+        kind, = SNAPSHOT_KIND.unpack_from(data, offset)
+        record = SNAPSHOT_RECORDS[kind].unpack_from(data, offset + SNAPSHOT_KIND.size)
+        offset += SNAPSHOT_KIND.size + SNAPSHOT_RECORDS[kind].size
+        if kind == SNAPSHOT_ISLAND:
+            state["sprites"].append({ "type": "Island", "pos": record })
+            continue
+        sprite = { "type": "User" if kind == SNAPSHOT_USER else "Enemy", "fwards_or_bwards": record[1], "pos": record[2:4],
+                   "prev_pos": record[4:6], "cur_turn": record[6], "turn_by": record[7], "movement_dir": record[8],
+                   "tur_end_pos": record[9:11], "is_reloading": bool(record[11]),
+                   "reload_done_at": None if record[12] == -1 else record[12], "health": record[13] }
+        if kind == SNAPSHOT_ENEMY:
+            sprite["id"], sprite["target"] = record[0], record[14:16]
+        state["sprites"].append(sprite)
+    return state
+
+def save_snapshot(path, G1, all_sprites):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(pack_state(G1.get_state(all_sprites)))
+
+def load_snapshot(path, G1, all_sprites):
+    #puts the saved match into G1 and all_sprites, and gives back the user
+    with open(path, "rb") as f:
+        return G1.set_state(unpack_state(f.read()), all_sprites)
+
+####################################################################
+
+def new_game(n_enemies=0, dirty_rects=False, profiler=None, seed=None):
+    G1 = Game({ "s_h": SCREEN_HEIGHT *  7 / 8, "s_w": SCREEN_WIDTH, "dirty_rects": dirty_rects, "profiler": profiler, "seed": seed })
+    dashboard = Dashboard()
+    all_sprites = EntityRegistry()
+    user = User({ "pos": (SCREEN_WIDTH /2,  SCREEN_HEIGHT * 7/8 - 30), "fwards_or_bwards": 1})
+    #enemy = Enemy({ "pos": (100, 100), "fwards_or_bwards": -1, "id": 1 })
+    I1 = Island({ "pos": (200,200) })
+    all_sprites.add(user, I1)#, #enemy)
+    for i in range(n_enemies):
+        all_sprites.add(Enemy({ "pos": (G1.rng.uniform(50, SCREEN_WIDTH - 50), G1.rng.uniform(50, SCREEN_HEIGHT / 2)), "fwards_or_bwards": -1, "id": G1.next_enemy_id }))
+        G1.next_enemy_id += 1
+    #the first frame can be drawn before the first tick, so the dashboard needs the health from the start
+    dashboard.update(user.get_health())
+    return G1, dashboard, all_sprites, user
+
+def run_headless(ticks, n_enemies=10, seed=None, profiler=None, record=None):
+    #plays a match with no window and no clock, as fast as the cpu goes. meant for balancing runs
+    #and regression checks, nobody is at the controls so the user just sits there and no events come in.
+    #it ends early if the user sinks, the same as main() stops at game over, G1.tick is how long they lasted
+    G1, dashboard, all_sprites, user = new_game(n_enemies, profiler=profiler, seed=seed)
+    if record:
+        G1.recorder = Recorder(G1.seed, n_enemies)
+    for tick in range(ticks):
+        with G1.profiler.section("update"):
+            G1.update(all_sprites, user, dashboard)
+        if user.get_health() <= 0:
+            break
+    if record:
+        G1.recorder.save(record, G1.tick)
+    return G1, all_sprites, user
+
+def main(dirty_rects=False, profiler=None, profile_out=None, record=None, governor=None):
+    #governor is a QualityGovernor to keep frame times in budget, or None to always draw everything
+    profiler = profiler or Profiler()
+
+    init_display()
+    icon = IconLoader()
+    high_scores = HighScores()
     pygame.display.set_caption("minimal program")
     screen = pygame.display.set_mode((SCREEN_WIDTH,SCREEN_HEIGHT))
+    first_frame = True
     game_started = False
     game_over = False
     running = True
     game_ready = False
-    menu = Menu()
+    menu = Menu(high_scores)
+    menu_drawn = False
     while running:
         if not game_started:
-            for event in pygame.event.get():
+            #nothing moves on the menu, so sleep until something happens (or 100ms, to pick up the icon)
+            event = pygame.event.wait(100)
+            events = [event] + pygame.event.get() if event.type != pygame.NOEVENT else []
+            for event in events:
+                    if event.type == pygame.WINDOWEXPOSED:
+                        menu_drawn = False
+
                     if event.type == pygame.QUIT:
                         running = False
+                        if profile_out:
+                            profiler.dump(profile_out)
+                        high_scores.close()
                         pygame.quit()
                         sys.exit()
 
                     if event.type == pygame.MOUSEBUTTONDOWN:
                         game_started = menu.select()
-            screen.fill((255,255,255))
-            menu.update(screen,pygame.mouse.get_pos())
-            menu.draw(screen)
-            pygame.event.pump()
-            pygame.display.update()
+                        menu_drawn = False
+            icon.apply()
+            if menu.update(pygame.mouse.get_pos()) or not menu_drawn:
+                menu.draw(screen)
+                pygame.display.update()
+                menu_drawn = True
+            if first_frame:
+                #time to first menu frame, from the moment this module started importing
+                first_frame = False
+                profiler.record("startup.first_menu_frame", time.perf_counter() - STARTED_AT)
+                if profiler.enabled:
+                    print("first menu frame after %.0fms" % ((time.perf_counter() - STARTED_AT) * 1000))
         elif game_started and not game_over:
             if not game_ready:
                 ########### CLASS CREATION
-                G1 = Game({ "s_h": SCREEN_HEIGHT *  7 / 8, "s_w": SCREEN_WIDTH })
-                dashboard = Dashboard()
-                all_sprites = pygame.sprite.Group()
-                user = User({ "pos": (SCREEN_WIDTH /2,  SCREEN_HEIGHT * 7/8 - 30), "fwards_or_bwards": 1})
-                #enemy = Enemy({ "pos": (100, 100), "fwards_or_bwards": -1, "id": 1 })
-                I1 = Island({ "pos": (200,200) })
-                all_sprites.add(user, I1)#, #enemy)
+                G1, dashboard, all_sprites, user = new_game(dirty_rects=dirty_rects, profiler=profiler)
+                if record:
+                    G1.recorder = Recorder(G1.seed, 0)
+                stepper = FixedStep()
+                if governor:
+                    G1.set_quality(governor.get_settings())
                 game_ready = True
                 ###########
-            for event in pygame.event.get():
-                    if event.type == pygame.QUIT:
-                        running = False
-                        pygame.quit()
-                        sys.exit()
-
-                    if event.type == pygame.KEYDOWN:
-                        G1.handle_key_down(event, user)
-
-                    if event.type == pygame.KEYUP:
-                        G1.handle_key_up(event, user)
-
-                    if event.type == pygame.MOUSEBUTTONDOWN:
-                        user.mouse_fire(all_sprites, pygame.mouse.get_pos())
-
-                    if event.type == EVENTS["ENEMY_RELOAD"]:
-                        for sprite in all_sprites:
-                            if sprite.__class__.__name__ == "Enemy":
-                                if event.__dict__["id"] == sprite.id:
-                                    sprite.stop_reload()
-
-            G1.update(all_sprites, user, dashboard)
-
-            screen.fill((255,255,255))
-            all_sprites = order_all_sprites(all_sprites)
-            G1.draw(screen, all_sprites, dashboard)
+            frame_start = time.perf_counter()
+            with profiler.section("events"):
+                for event in pygame.event.get():
+                        if event.type == pygame.QUIT:
+                            running = False
+                            if profile_out:
+                                profiler.dump(profile_out)
+                            if record:
+                                G1.recorder.save(record, G1.tick)
+                            high_scores.add(G1.user_score)
+                            high_scores.close()
+                            pygame.quit()
+                            sys.exit()
+
+                        if event.type == pygame.KEYDOWN and event.key in (pygame.K_F5, pygame.K_F9):
+                            #quick save and load, they aren't part of the match so they never get recorded.
+                            #a replay can't jump to a loaded match, so there is no loading while recording
+                            if event.key == pygame.K_F5:
+                                save_snapshot(SAVE_PATH, G1, all_sprites)
+                            elif G1.recorder:
+                                print("quick load is off while recording, the replay couldn't follow it")
+                            elif os.path.exists(SAVE_PATH):
+                                user = load_snapshot(SAVE_PATH, G1, all_sprites)
+                            continue
+
+                        G1.handle_event(event, all_sprites, user)
+
+            #however long the last frame took, the simulation catches up in fixed ticks
+            for i in range(stepper.advance()):
+                with profiler.section("update"):
+                    G1.update(all_sprites, user, dashboard)
+            if user.get_health() <= 0:
+                game_over = True
+
+            #map and dashboard cover the whole screen between them so there is nothing to fill
+            with profiler.section("draw"):
+                dirty = G1.draw(screen, all_sprites, dashboard, stepper.get_alpha())
         
             pygame.event.pump()
-            pygame.display.update()
+            with profiler.section("display.update"):
+                if dirty is None:
+                    pygame.display.update()
+                else:
+                    pygame.display.update(dirty)
+            if profiler.enabled:
+                profiler.record("frame", time.perf_counter() - frame_start)
+            if governor and governor.record(time.perf_counter() - frame_start):
+                G1.set_quality(governor.get_settings())
+                if profiler.enabled:
+                    print("quality level %d: %s" % (governor.level, governor.reason))
 
         elif game_over:
+            high_scores.add(G1.user_score)
+            if profile_out:
+                profiler.dump(profile_out)
+            if record:
+                G1.recorder.save(record, G1.tick)
             screen.fill((255, 0, 0))
-            screen.blit(font.render("Game Over", True, (0,0,0)), (30,250))
+            screen.blit(get_font(60).render("Game Over", True, (0,0,0)), (30,250))
             pygame.display.update()
             time.sleep(1.5)
+            high_scores.close()
             pygame.quit()
             sys.exit() 
 
@@ -582,5 +1970,45 @@ def main():
 # run the main function only if this module is executed as the main script
 # (if you import this as a module then nothing is executed)
 if __name__=="__main__":
-    # call the main function
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dirty-rects", action="store_true", help="only redraw the parts of the screen that changed")
+    parser.add_argument("--headless", type=int, metavar="TICKS", help="simulate TICKS ticks with no window and exit")
+    parser.add_argument("--enemies", type=int, default=10, help="enemies to start a headless match with")
+    parser.add_argument("--seed", type=int, help="random seed for a headless match")
+    parser.add_argument("--antialias", action="store_true", help="smooth the edges of the boats")
+    parser.add_argument("--frame-budget", type=float, default=1000 / TICK_RATE, metavar="MS",
+                        help="drop detail when frames take longer than this on average, 0 to never drop any")
+    parser.add_argument("--profile", action="store_true", help="time the hot paths and show them on the dashboard")
+    parser.add_argument("--profile-out", metavar="FILE", help="write the timings to FILE (.json or .csv) on exit, implies --profile")
+    parser.add_argument("--record", metavar="FILE", help="record the match to FILE as a replay")
+    parser.add_argument("--replay", metavar="FILE", help="play back a recorded match with no window and exit")
+    parser.add_argument("--speed", type=float, default=0, help="replay speed as a multiple of real time, 0 for as fast as possible")
+    parser.add_argument("--seek", type=int, metavar="TICK", help="only replay up to TICK")
+    args = parser.parse_args()
+    profiler = Profiler(enabled=args.profile or bool(args.profile_out))
+    boat_art.antialias = args.antialias
+    if args.replay:
+        start = time.perf_counter()
+        replay = Replay(args.replay)
+        if args.seek is not None:
+            replay.seek(args.seek)
+        else:
+            replay.play(args.speed)
+        took = time.perf_counter() - start
+        print("replayed %d of %d ticks in %.2fs (%.0fx real time), score %d, user health %d, %d sprites" %
+              (replay.G1.tick, replay.ticks, took, replay.G1.tick / TICK_RATE / took, replay.G1.user_score,
+               replay.user.get_health(), len(replay.all_sprites)))
+    elif args.headless:
+        start = time.perf_counter()
+        G1, all_sprites, user = run_headless(args.headless, args.enemies, args.seed, profiler, args.record)
+        took = time.perf_counter() - start
+        print("%d ticks in %.2fs (%.0f ticks/s)%s, score %d, user health %d, %d sprites" %
+              (G1.tick, took, G1.tick / took, ", the user sank" if user.get_health() <= 0 else "",
+               G1.user_score, user.get_health(), len(all_sprites)))
+        print("entities touched on the last tick: " + ", ".join("%s %d" % (k, v) for k, v in all_sprites.touched.items()))
+        if args.profile_out:
+            profiler.dump(args.profile_out)
+    else:
+        # call the main function
+        governor = QualityGovernor(args.frame_budget / 1000, args.antialias) if args.frame_budget else None
+        main(dirty_rects=args.dirty_rects, profiler=profiler, profile_out=args.profile_out, record=args.record, governor=governor)
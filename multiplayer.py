@@ -0,0 +1,671 @@
+import argparse, asyncio, csv, math, random, struct
+from collections import deque
+import numpy as np
+import pygame
+
+from game import (SCREEN_WIDTH, SCREEN_HEIGHT, TICK_RATE, RELOAD_TICKS, LAYERS, init_display, new_game,
+                  Game, Dashboard, EntityRegistry, Projectiles, Island, User, Enemy)
+
+####################################################################
+    #WIRE FORMAT
+####################################################################
+
+#every message is a length and a kind then the body, all little endian like the replay files
+FRAME = struct.Struct("<IB")
+MSG_HELLO, MSG_WELCOME, MSG_INPUT, MSG_SNAPSHOT = 1, 2, 3, 4
+#welcome: which player you are, the match seed, the tick the server is on
+WELCOME = struct.Struct("<BQI")
+#input: input number, newest snapshot tick the client has (the ack), move, turn, fire, where the turret points
+INPUT = struct.Struct("<IIbbBhh")
+#snapshot: tick, the tick it is a delta against (NO_BASELINE for none), the last of this client's inputs
+#that went into it, score, map progress, then how many entities changed and how many are gone
+SNAPSHOT = struct.Struct("<IIIiiHH")
+NO_BASELINE = 0xFFFFFFFF
+#a changed entity is its kind, id, which of its fields follow and which of those are only a
+#difference from the baseline small enough for one byte. a gone one is just kind and id
+ENTITY = struct.Struct("<BHBB")
+GONE = struct.Struct("<BH")
+
+#what goes over the wire for each kind of entity, field names and struct codes. positions are in 1/8px,
+#boat headings in 65536ths of a turn, turrets in 256ths and projectile directions in 127ths. flags are
+#the projectile kind plus 2 if it is friendly. age only matters for shrapnel, shells always send 0
+NET_USER, NET_ENEMY, NET_ISLAND, NET_PROJECTILE, NET_SINK_SPOT = 0, 1, 2, 3, 4
+NET_FIELDS = {
+    NET_USER: (("x", "h"), ("y", "h"), ("turn", "H"), ("turret", "B"), ("health", "h")),
+    NET_ENEMY: (("x", "h"), ("y", "h"), ("turn", "H"), ("turret", "B"), ("health", "h")),
+    NET_ISLAND: (("x", "h"), ("y", "h")),
+    NET_PROJECTILE: (("x", "h"), ("y", "h"), ("dx", "b"), ("dy", "b"), ("age", "B"), ("flags", "B")),
+    NET_SINK_SPOT: (("x", "h"), ("y", "h"), ("radius", "B")),
+}
+#how many ticks of snapshots the server keeps to make deltas against. a client whose ack is older
+#than this gets the whole world again
+HISTORY_TICKS = TICK_RATE
+#inputs a client can get ahead of the server by before the oldest ones are skipped
+MAX_BACKLOG = TICK_RATE // 10
+packers = {}
+
+def get_packer(kind, mask, small):
+    #struct for whichever of a kind's fields are set in mask, with the ones in small as a signed byte.
+    #made the first time each combination turns up
+    if (kind, mask, small) not in packers:
+        codes = ["b" if small >> i & 1 else code for i, (name, code) in enumerate(NET_FIELDS[kind]) if mask >> i & 1]
+        packers[(kind, mask, small)] = struct.Struct("<" + "".join(codes))
+    return packers[(kind, mask, small)]
+
+def quantise_position(values):
+    #px to 1/8px, works on one number or a whole array
+    return np.clip(np.round(np.asarray(values) * 8), -32768, 32767).astype(int).tolist()
+
+def quantise_angle(degrees, steps):
+    return round(degrees % 360 * steps / 360) % steps
+
+def quantise_boat(boat):
+    center = boat.get_center()
+    x, y = quantise_position(boat.pos)
+    turret = math.degrees(math.atan2(boat.tur_end_pos[1] - center[1], boat.tur_end_pos[0] - center[0]))
+    return (x, y, quantise_angle(boat.cur_turn, 65536), quantise_angle(turret, 256), max(-32768, min(32767, int(boat.health))))
+
+def apply_boat(boat, values):
+    #puts a quantised boat back onto a Boat, close enough to draw or to predict on from
+    x, y, turn, turret, health = values
+    boat.pos = boat.prev_pos = (x / 8, y / 8)
+    boat.cur_turn = turn * 360 / 65536
+    center, angle = boat.get_center(), math.radians(turret * 360 / 256)
+    boat.tur_end_pos = (center[0] + 15 * math.cos(angle), center[1] + 15 * math.sin(angle))
+    boat.health = health
+
+def frame(kind, body):
+    return FRAME.pack(len(body), kind) + body
+
+async def read_message(reader):
+    length, kind = FRAME.unpack(await reader.readexactly(FRAME.size))
+    return kind, await reader.readexactly(length)
+
+def encode_snapshot(tick, baseline_tick, baseline, world, last_input, score, progress):
+    #world and baseline are { (kind, id): quantised fields }. only entities that differ from the baseline
+    #go in, and of those only the fields that changed, as a one byte difference where that's enough.
+    #anything in the baseline but not the world is gone
+    changed = []
+    for key, values in world.items():
+        old = baseline.get(key)
+        if old == values:
+            continue
+        if old is None:
+            mask, small, sent = (1 << len(values)) - 1, 0, values
+        else:
+            mask, small, sent = 0, 0, []
+            for i, (value, was) in enumerate(zip(values, old)):
+                if value != was:
+                    mask |= 1 << i
+                    if -128 <= value - was <= 127:
+                        small |= 1 << i
+                        value -= was
+                    sent.append(value)
+        changed.append(ENTITY.pack(key[0], key[1], mask, small) + get_packer(key[0], mask, small).pack(*sent))
+    gone = [GONE.pack(*key) for key in baseline if key not in world]
+    return (SNAPSHOT.pack(tick, baseline_tick, last_input, score, progress, len(changed), len(gone)) +
+            b"".join(changed) + b"".join(gone))
+
+def decode_snapshot(data, worlds):
+    #the other way round, worlds are the ones this client already has by tick to find the baseline in
+    tick, baseline_tick, last_input, score, progress, n_changed, n_gone = SNAPSHOT.unpack_from(data)
+    if baseline_tick != NO_BASELINE and baseline_tick not in worlds:
+        raise ValueError("snapshot %d is a delta against %d, which isn't one of ours" % (tick, baseline_tick))
+    world = dict(worlds[baseline_tick]) if baseline_tick != NO_BASELINE else {}
+    offset = SNAPSHOT.size
+    for i in range(n_changed):
+        kind, id, mask, small = ENTITY.unpack_from(data, offset)
+        packer = get_packer(kind, mask, small)
+        sent = iter(packer.unpack_from(data, offset + ENTITY.size))
+        offset += ENTITY.size + packer.size
+        old = world.get((kind, id))
+        if old is None:
+            world[(kind, id)] = tuple(sent)
+        else:
+            world[(kind, id)] = tuple((was + next(sent) if small >> n & 1 else next(sent)) if mask >> n & 1 else was
+                                      for n, was in enumerate(old))
+    for i in range(n_gone):
+        del world[GONE.unpack_from(data, offset)]
+        offset += GONE.size
+    return tick, baseline_tick, last_input, score, progress, world
+
+class Link():
+    #one end of a connection. lag holds every message back that long before it goes out, so a loopback
+    #run can behave like a real network. one task sends them in order
+    def __init__(self, writer, lag=0):
+        self.writer = writer
+        self.lag = lag
+        self.bytes_sent = 0
+        self.queue = asyncio.Queue()
+        self.sender = asyncio.ensure_future(self.send_delayed()) if lag else None
+
+    def send(self, kind, body):
+        data = frame(kind, body)
+        self.bytes_sent += len(data)
+        if self.sender:
+            self.queue.put_nowait((asyncio.get_running_loop().time() + self.lag, data))
+        elif not self.writer.is_closing():
+            self.writer.write(data)
+        return len(data)
+
+    async def send_delayed(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            due, data = await self.queue.get()
+            await asyncio.sleep(max(0, due - loop.time()))
+            if self.writer.is_closing():
+                return
+            self.writer.write(data)
+
+    def close(self):
+        if self.sender:
+            self.sender.cancel()
+        self.writer.close()
+
+####################################################################
+    #SERVER
+####################################################################
+
+class Player():
+    def __init__(self, data):
+        self.slot = data["slot"]
+        self.user = data["user"]
+        self.link = None
+        self.connected = False
+        self.reset()
+
+    def reset(self):
+        #everything that belongs to one connection, a slot taken again after a drop starts over
+        #(input number, move, turn, fire, aim) in the order they came in, one is used a tick
+        self.inputs = deque()
+        self.last_input = 0
+        #newest snapshot the client said it has, and when each snapshot went out to time the round trip
+        self.acked = NO_BASELINE
+        self.sent_at = {}
+        self.rtt = None
+
+class Server():
+    #runs the only real copy of the match. every tick it takes an input from each player, runs
+    #Game.update and sends each client what changed since the last snapshot that client acked.
+    #the map scrolls with the first player still afloat, the same way it follows the single player
+    def __init__(self, data):
+        self.lag = data.get("lag", 0)
+        self.G1, self.dashboard, self.all_sprites, user = new_game(data.get("enemies", 25), seed=data.get("seed"))
+        #new_game's user is swapped for one per player, spread out either side of where it was
+        self.all_sprites.remove(user)
+        n_players = data.get("players", 2)
+        self.players = []
+        for slot in range(n_players):
+            user = User({ "pos": (SCREEN_WIDTH / 2 + (slot - (n_players - 1) / 2) * 100, SCREEN_HEIGHT * 7/8 - 30), "fwards_or_bwards": 1 })
+            self.all_sprites.add(user)
+            self.players.append(Player({ "slot": slot, "user": user }))
+        self.island_ids, self.next_island_id = {}, 0
+        self.history = {}
+        self.ready = asyncio.Event()
+        self.handlers = set()
+        #a row per tick for the report, see run_loopback. without "report" only the newest row is kept for
+        #the progress lines, a --serve match can go on for hours
+        self.report = [] if data.get("report") else deque(maxlen=1)
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def handle(self, reader, writer):
+        #one of these runs for each connection, it only ever queues up inputs for step() to use
+        self.handlers.add(asyncio.current_task())
+        try:
+            kind, body = await read_message(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        player = next((player for player in self.players if not player.connected), None)
+        if kind != MSG_HELLO or player is None:
+            writer.close()
+            return
+        player.reset()
+        player.link, player.connected = Link(writer, self.lag / 2), True
+        player.link.send(MSG_WELCOME, WELCOME.pack(player.slot, self.G1.seed, self.G1.tick))
+        if all(player.connected for player in self.players):
+            self.ready.set()
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                kind, body = await read_message(reader)
+                if kind != MSG_INPUT:
+                    continue
+                number, ack, move, turn, fire, aim_x, aim_y = INPUT.unpack(body)
+                player.inputs.append((number, move, turn, fire, (aim_x, aim_y)))
+                if ack == NO_BASELINE:
+                    #nothing acked, either it hasn't had a snapshot yet or it lost track and wants the whole world again
+                    player.acked = NO_BASELINE
+                elif player.acked == NO_BASELINE or ack > player.acked:
+                    player.acked = ack
+                    #the ack only goes out with the client's next input, so this is up to a tick over the real round trip
+                    if ack in player.sent_at:
+                        player.rtt = loop.time() - player.sent_at[ack]
+                    player.sent_at = { tick: at for tick, at in player.sent_at.items() if tick > ack }
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        player.connected = False
+        player.link.close()
+
+    def apply_input(self, player):
+        #no input this tick means carry on the way it was going
+        user = player.user
+        while player.inputs:
+            number, move, turn, fire, aim = player.inputs.popleft()
+            player.last_input = number
+            if not user.alive():
+                continue
+            if fire:
+                user.mouse_fire(self.G1.projectiles, self.G1.timers, aim)
+            #a client that got too far ahead has its oldest inputs skipped, but still gets their shots
+            if len(player.inputs) < MAX_BACKLOG:
+                user.movement_dir, user.turn_by = move, turn
+                user.set_tur_end_pos(user.get_center(), aim)
+                break
+
+    def capture(self):
+        #the whole match quantised the way the clients see it, { (kind, id): fields }
+        world = {}
+        for player in self.players:
+            if player.user.alive():
+                world[(NET_USER, player.slot)] = quantise_boat(player.user)
+        for enemy in self.all_sprites.of_type("Enemy"):
+            world[(NET_ENEMY, enemy.id)] = quantise_boat(enemy)
+        #islands have no ids of their own so they get one the first time they are seen
+        island_ids = {}
+        for island in self.all_sprites.of_type("Island"):
+            if island not in self.island_ids:
+                self.island_ids[island] = self.next_island_id
+                self.next_island_id += 1
+            island_ids[island] = self.island_ids[island]
+            world[(NET_ISLAND, island_ids[island])] = (island.rect.x, island.rect.y)
+        self.island_ids = island_ids
+        #projectiles and sink spots go by their slot in the pool
+        projectiles = self.G1.projectiles
+        live = np.flatnonzero(projectiles.alive)
+        kind = projectiles.kind[live].astype(int)
+        fields = zip(live.tolist(), quantise_position(projectiles.x[live]), quantise_position(projectiles.y[live]),
+                     np.round(projectiles.dx[live] * 127).astype(int).tolist(), np.round(projectiles.dy[live] * 127).astype(int).tolist(),
+                     np.where(kind == Projectiles.SHRAPNEL, np.minimum(projectiles.age[live], 255), 0).tolist(),
+                     (kind + projectiles.is_friendly[live] * 2).tolist())
+        for i, *values in fields:
+            world[(NET_PROJECTILE, i)] = tuple(values)
+        sink_spots = self.G1.sink_spots
+        live = np.flatnonzero(sink_spots.alive)
+        for i, x, y, radius in zip(live.tolist(), quantise_position(sink_spots.x[live]), quantise_position(sink_spots.y[live]),
+                                   np.clip(np.round(sink_spots.radius[live] * 8), 0, 255).astype(int).tolist()):
+            world[(NET_SINK_SPOT, i)] = (x, y, radius)
+        return world
+
+    def step(self):
+        for player in self.players:
+            self.apply_input(player)
+        afloat = [player.user for player in self.players if player.user.alive()]
+        self.G1.update(self.all_sprites, afloat[0] if afloat else self.players[0].user, self.dashboard)
+        #sunk players stay connected and keep watching
+        for user in afloat:
+            if user.get_health() <= 0:
+                user.de_spawn(self.all_sprites, self.G1.sink_spots)
+        tick, world = self.G1.tick, self.capture()
+        self.history[tick] = world
+        for old in [old for old in self.history if old <= tick - HISTORY_TICKS]:
+            del self.history[old]
+        now = asyncio.get_running_loop().time()
+        row = { "tick": tick, "entities": len(world), "players": [] }
+        #what it would cost without the deltas, for comparison
+        row["full_bytes"] = FRAME.size + len(encode_snapshot(tick, NO_BASELINE, {}, world, 0, self.G1.user_score, self.G1.progress))
+        for player in self.players:
+            if not player.connected:
+                row["players"].append(None)
+                continue
+            baseline_tick = player.acked if player.acked in self.history else NO_BASELINE
+            body = encode_snapshot(tick, baseline_tick, self.history.get(baseline_tick, {}), world,
+                                   player.last_input, self.G1.user_score, self.G1.progress)
+            sent = player.link.send(MSG_SNAPSHOT, body)
+            player.sent_at[tick] = now
+            row["players"].append({ "bytes": sent, "changed": SNAPSHOT.unpack_from(body)[5], "delta": baseline_tick != NO_BASELINE,
+                                    "rtt": player.rtt, "backlog": len(player.inputs) })
+        self.report.append(row)
+
+    async def run(self, ticks=None, progress_every=None):
+        #at a fixed TICK_RATE from when everyone has joined. with no ticks it goes until every player has sunk
+        await self.ready.wait()
+        loop = asyncio.get_running_loop()
+        start, first = loop.time(), self.G1.tick
+        while self.G1.tick - first < ticks if ticks is not None else any(player.user.alive() for player in self.players):
+            self.step()
+            if progress_every and self.G1.tick % progress_every == 0:
+                print(describe_row(self.report[-1]))
+            await asyncio.sleep(max(0, start + (self.G1.tick - first) / TICK_RATE - loop.time()))
+        await self.stop()
+
+    async def stop(self):
+        #closing each link ends its handler, they are waited for so nothing is left running
+        for player in self.players:
+            if player.link:
+                player.link.close()
+        self.server.close()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+
+####################################################################
+    #CLIENT
+####################################################################
+
+class Bot():
+    #plays a client on its own for loopback runs, sails about at random and shoots at the nearest enemy it can see
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.move, self.turn, self.ticks = 0, 0, 0
+
+    def __call__(self, client):
+        self.ticks += 1
+        if self.ticks % TICK_RATE == 1:
+            self.move, self.turn = self.rng.choice((1, 1, 0, -1)), self.rng.choice((-1, 0, 0, 1))
+        aim, fire = (0, 0), False
+        if client.user is not None:
+            center = client.user.get_center()
+            enemies = [(fields[0] / 8, fields[1] / 8) for (kind, id), fields in client.world.items() if kind == NET_ENEMY]
+            if enemies:
+                aim = min(enemies, key=lambda pos: (pos[0] - center[0]) ** 2 + (pos[1] - center[1]) ** 2)
+                fire = self.ticks % RELOAD_TICKS == 0
+        return self.move, self.turn, fire, aim
+
+class KeyboardControls():
+    #w s a d to sail and click to fire, same as the single player game
+    def __init__(self):
+        self.move, self.turn = 0, 0
+
+    def __call__(self, client):
+        fire = False
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                client.running = False
+            elif event.type == pygame.KEYDOWN:
+                if event.unicode in ("w", "s"):
+                    self.move = 1 if event.unicode == "w" else -1
+                if event.unicode in ("a", "d"):
+                    self.turn = -1 if event.unicode == "a" else 1
+            elif event.type == pygame.KEYUP:
+                if event.unicode in ("w", "s") and self.move == (1 if event.unicode == "w" else -1):
+                    self.move = 0
+                if event.unicode in ("a", "d"):
+                    self.turn = 0
+            elif event.type == pygame.MOUSEBUTTONDOWN:
+                fire = True
+        return self.move, self.turn, fire, pygame.mouse.get_pos()
+
+class Client():
+    #joins a server, sends an input every tick and keeps the world from the snapshots that come back.
+    #its own boat is moved as soon as the input is made (prediction), then whenever a snapshot says
+    #where the server had it, it is put there and the inputs the server hasn't got to yet are played again
+    def __init__(self, data):
+        self.lag = data.get("lag", 0)
+        #called every tick with the client, gives back (move, turn, fire, aim)
+        self.controls = data["controls"]
+        self.slot = None
+        self.running = True
+        self.started = asyncio.Event()
+        #snapshots by tick, any of them could be the baseline for the next one
+        self.worlds = {}
+        self.latest = NO_BASELINE
+        self.world = {}
+        self.score, self.progress = 0, 0
+        self.user = None
+        self.input_number = 0
+        #(input number, move, turn, where the boat was predicted to end up, when it was sent)
+        self.pending = deque()
+        #how far the prediction was out and how long each input took to show up in a snapshot, all of
+        #them with "report" and otherwise just the newest
+        self.errors, self.latencies = ([], []) if data.get("report") else (deque(maxlen=1), deque(maxlen=1))
+        #only made when there is a screen to draw on
+        self.view = None
+
+    async def connect(self, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        self.link = Link(writer, self.lag / 2)
+        self.link.send(MSG_HELLO, b"")
+        try:
+            kind, body = await read_message(reader)
+        except asyncio.IncompleteReadError:
+            kind = None
+        if kind != MSG_WELCOME:
+            writer.close()
+            raise ConnectionError("%s:%d didn't let us in, the match is probably full" % (host, port))
+        self.slot, self.seed, tick = WELCOME.unpack(body)
+        self.listener = asyncio.ensure_future(self.listen(reader))
+
+    async def listen(self, reader):
+        try:
+            while True:
+                kind, body = await read_message(reader)
+                if kind == MSG_SNAPSHOT:
+                    self.receive(body)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        #the server went away, most likely the match is over
+        self.running = False
+        self.started.set()
+
+    def receive(self, body):
+        try:
+            tick, baseline_tick, last_input, self.score, self.progress, self.world = decode_snapshot(body, self.worlds)
+        except ValueError:
+            #no baseline to apply it to, so it is dropped and the next input acks nothing, which gets
+            #the whole world sent again
+            self.latest = NO_BASELINE
+            return
+        self.worlds[tick] = self.world
+        #acks only go up, so nothing older than this snapshot's baseline will be needed again
+        oldest = tick - HISTORY_TICKS if baseline_tick == NO_BASELINE else baseline_tick
+        for old in [old for old in self.worlds if old < oldest]:
+            del self.worlds[old]
+        self.latest = tick
+        self.started.set()
+        self.reconcile(last_input)
+
+    def reconcile(self, last_input):
+        own = self.world.get((NET_USER, self.slot))
+        if own is None:
+            self.user = None
+            return
+        if self.user is None:
+            self.user = User({ "pos": (own[0] / 8, own[1] / 8), "fwards_or_bwards": 1 })
+        now = asyncio.get_running_loop().time()
+        while self.pending and self.pending[0][0] <= last_input:
+            number, move, turn, predicted, sent_at = self.pending.popleft()
+            if number == last_input and predicted is not None:
+                self.errors.append(math.hypot(predicted[0] - own[0] / 8, predicted[1] - own[1] / 8))
+                self.latencies.append(now - sent_at)
+        #the turret is whatever the player is aiming at, only the server's word on everything else counts
+        tur_end_pos = self.user.tur_end_pos
+        apply_boat(self.user, own)
+        self.user.tur_end_pos = tur_end_pos
+        for number, move, turn, predicted, sent_at in self.pending:
+            self.predict(move, turn)
+
+    def predict(self, move, turn):
+        self.user.movement_dir, self.user.turn_by = move, turn
+        self.user.move(None)
+
+    def send_input(self, move, turn, fire, aim):
+        self.input_number += 1
+        predicted = None
+        if self.user is not None:
+            self.predict(move, turn)
+            predicted = self.user.pos
+        self.pending.append((self.input_number, move, turn, predicted, asyncio.get_running_loop().time()))
+        aim_x, aim_y = (max(-32768, min(32767, int(v))) for v in aim)
+        self.link.send(MSG_INPUT, INPUT.pack(self.input_number, self.latest, move, turn, bool(fire), aim_x, aim_y))
+
+    async def run(self, screen=None):
+        #starts from the first snapshot so no inputs pile up at the server before the match does
+        await self.started.wait()
+        loop = asyncio.get_running_loop()
+        start, ticks = loop.time(), 0
+        while self.running:
+            self.send_input(*self.controls(self))
+            if screen is not None:
+                self.draw(screen)
+            ticks += 1
+            await asyncio.sleep(max(0, start + ticks / TICK_RATE - loop.time()))
+        self.link.close()
+
+    def sync_view(self):
+        #turns the latest snapshot back into sprites and pools that the normal drawing code can use
+        view = self.view
+        view.progress = self.progress
+        sprites = {}
+        for key, fields in self.world.items():
+            kind, id = key
+            if kind == NET_ISLAND:
+                sprite = self.view_sprites.get(key) or Island({ "pos": fields })
+                sprite.rect.topleft = fields
+            elif kind == NET_ENEMY or kind == NET_USER and id != self.slot:
+                sprite = self.view_sprites.get(key)
+                if sprite is None:
+                    sprite = Enemy({ "pos": (0, 0), "fwards_or_bwards": -1, "id": id }) if kind == NET_ENEMY else User({ "pos": (0, 0), "fwards_or_bwards": 1 })
+                apply_boat(sprite, fields)
+            else:
+                continue
+            sprites[key] = sprite
+        if self.user is not None:
+            sprites["user"] = self.user
+        self.sprites.remove(*[sprite for key, sprite in self.view_sprites.items() if sprites.get(key) is not sprite])
+        self.sprites.add(*[sprite for sprite in sprites.values() if sprite not in self.sprites])
+        self.view_sprites = sprites
+        for pool, kind in ((view.projectiles, NET_PROJECTILE), (view.sink_spots, NET_SINK_SPOT)):
+            pool.alive[:] = False
+            for (entity_kind, i), fields in self.world.items():
+                if entity_kind != kind:
+                    continue
+                while i >= pool.capacity:
+                    pool.grow(pool.capacity * 2)
+                pool.alive[i] = True
+                pool.x[i], pool.y[i] = fields[0] / 8, fields[1] / 8
+                if kind == NET_PROJECTILE:
+                    pool.dx[i], pool.dy[i], pool.age[i] = fields[2] / 127, fields[3] / 127, fields[4]
+                    pool.kind[i], pool.is_friendly[i] = fields[5] & 1, fields[5] >> 1
+                    pool.prev_x[i], pool.prev_y[i] = pool.x[i], pool.y[i]
+                else:
+                    pool.radius[i] = fields[2] / 8
+        self.drawn = self.latest
+
+    def draw(self, screen):
+        if self.view is None:
+            self.view = Game({ "s_h": SCREEN_HEIGHT *  7 / 8, "s_w": SCREEN_WIDTH, "seed": self.seed })
+            self.sprites, self.view_sprites, self.drawn = EntityRegistry(), {}, None
+            self.dashboard = Dashboard()
+        view = self.view
+        if self.drawn != self.latest:
+            self.sync_view()
+        view.step_waves()
+        if self.user is not None:
+            self.user.set_tur_end_pos(self.user.get_center(), pygame.mouse.get_pos())
+        view.draw_waves()
+        for name in LAYERS:
+            for sprite in self.sprites.of_type(name):
+                sprite.draw(view.map_surface)
+            if name == "Island":
+                view.sink_spots.draw(view.map_surface)
+        view.projectiles.draw(view.map_surface)
+        screen.blit(view.map_surface, view.rect)
+        self.dashboard.update(max(self.user.get_health(), 0) if self.user else 0)
+        self.dashboard.draw(screen, self.score)
+        pygame.display.update()
+
+####################################################################
+    #LOOPBACK RUNS
+####################################################################
+
+def describe_row(row):
+    parts = ["tick %5d  %4d entities  full %6d B" % (row["tick"], row["entities"], row["full_bytes"])]
+    for slot, player in enumerate(row["players"]):
+        if player:
+            parts.append("p%d %5d B %4s rtt" % (slot + 1, player["bytes"], "%.0fms" % (player["rtt"] * 1000) if player["rtt"] is not None else "-"))
+    return "  ".join(parts)
+
+def write_report(path, report, n_players):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["tick", "entities", "full_bytes"] + ["p%d_%s" % (slot + 1, name) for slot in range(n_players)
+                                                              for name in ("bytes", "changed", "delta", "rtt_ms", "backlog")])
+        for row in report:
+            line = [row["tick"], row["entities"], row["full_bytes"]]
+            for player in row["players"]:
+                line.extend([player["bytes"], player["changed"], int(player["delta"]),
+                             "" if player["rtt"] is None else round(player["rtt"] * 1000, 2), player["backlog"]] if player else [""] * 5)
+            writer.writerow(line)
+
+def summarise(server, clients):
+    report = server.report
+    entities = np.array([row["entities"] for row in report])
+    full = np.array([row["full_bytes"] for row in report])
+    print("%d ticks, %d to %d entities (mean %.0f), a full snapshot averages %.0f B" %
+          (len(report), entities.min(), entities.max(), entities.mean(), full.mean()))
+    print("%8s %12s %10s %10s %8s %10s %10s %14s %14s" % ("player", "B/tick", "p95 B", "kB/s", "saved", "rtt p50", "rtt p95",
+                                                           "input->ack p95", "predict err px"))
+    for client in clients:
+        sent = [row["players"][client.slot] for row in report if row["players"][client.slot]]
+        sizes = np.array([player["bytes"] for player in sent])
+        rtts = np.array([player["rtt"] for player in sent if player["rtt"] is not None] or [np.nan]) * 1000
+        latencies = np.array(client.latencies or [np.nan]) * 1000
+        errors = np.array(client.errors or [np.nan])
+        print("%8d %12.0f %10.0f %10.1f %7.0f%% %8.1fms %8.1fms %12.1fms %8.3f/%.3f" %
+              (client.slot + 1, sizes.mean(), np.percentile(sizes, 95), sizes.mean() * TICK_RATE / 1000,
+               (1 - sizes.sum() / full[:len(sizes)].sum()) * 100, np.percentile(rtts, 50), np.percentile(rtts, 95),
+               np.percentile(latencies, 95), np.nanmean(errors), np.nanmax(errors)))
+
+async def run_loopback(ticks, n_players=2, n_enemies=50, seed=None, lag=0, progress_every=TICK_RATE):
+    #a server and n_players bots all on localhost in this one process
+    server = Server({ "players": n_players, "enemies": n_enemies, "seed": seed, "lag": lag, "report": True })
+    host, port = await server.start("127.0.0.1", 0)
+    clients = []
+    for slot in range(n_players):
+        client = Client({ "lag": lag, "controls": Bot(server.G1.seed + slot), "report": True })
+        await client.connect(host, port)
+        clients.append(client)
+    await asyncio.gather(server.run(ticks, progress_every), *(client.run() for client in clients))
+    return server, clients
+
+async def serve(host, port, n_players, n_enemies, seed, ticks):
+    server = Server({ "players": n_players, "enemies": n_enemies, "seed": seed })
+    host, port = await server.start(host, port)
+    print("waiting on %s:%d for %d to join" % (host, port, n_players))
+    await server.run(ticks, progress_every=TICK_RATE * 5)
+
+async def join(host, port, lag):
+    init_display()
+    pygame.display.set_caption("Frigate")
+    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    client = Client({ "lag": lag, "controls": KeyboardControls() })
+    await client.connect(host, port)
+    print("joined as player %d, waiting for everyone else" % (client.slot + 1))
+    await client.run(screen)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--serve", action="store_true", help="host a match and wait for the players to join")
+    parser.add_argument("--join", metavar="HOST", help="join the match on HOST and play it in a window")
+    parser.add_argument("--port", type=int, default=5999)
+    parser.add_argument("--players", type=int, default=2)
+    parser.add_argument("--enemies", type=int, default=50, help="enemies the match starts with")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--ticks", type=int, help="end the match after this many ticks, 600 for a loopback run")
+    parser.add_argument("--lag", type=float, default=0, metavar="MS", help="round trip time to add on top of the network's own")
+    parser.add_argument("--report", metavar="FILE", help="write the loopback run's bandwidth and latency for every tick to a .csv file")
+    args = parser.parse_args()
+    if args.join:
+        asyncio.run(join(args.join, args.port, args.lag / 1000))
+    else:
+        init_display(headless=True)
+        if args.serve:
+            asyncio.run(serve("0.0.0.0", args.port, args.players, args.enemies, args.seed, args.ticks))
+        else:
+            #with neither, the whole thing runs over localhost with bots playing and the numbers are printed
+            server, clients = asyncio.run(run_loopback(args.ticks or 600, args.players, args.enemies, args.seed, args.lag / 1000))
+            summarise(server, clients)
+            if args.report:
+                write_report(args.report, server.report, args.players)